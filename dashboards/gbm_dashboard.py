@@ -1,26 +1,40 @@
+import math
 import time
 
 import dash
 from dash import Dash, html, dcc, callback, Output, Input, State, dash_table, DiskcacheManager
 import plotly.express as px
 import pandas as pd
-import sqlite3
 import numpy as np
 
-from stochastic.gbm_func import brownian_motion
+from stochastic.gbm_func import brownian_motion, gbm_var
+from stochastic.gbm_scan import iter_scan, var_scan
+from utils.connection_pool import ConnectionPool
 from utils.get_all_available_tickers import get_all_available_tickers
-from utils.load_stock import load_prices
+from utils.load_stock import load_prices, load_price_page, page_columns
+from utils.price_store import db_version
+from utils.downsample import downsample
+from utils import stats_cache
 import diskcache
 
-cache = diskcache.Cache("./cache")
+#Shared by the background callbacks and the memoized results below. Entries are keyed by the database
+#version as well, so a refresh of the price store makes old results unreachable; they expire after
+#cache_ttl seconds or are evicted least-recently-used once the cache grows past its size limit
+cache_ttl = 15 * 60
+cache = diskcache.Cache("./cache", size_limit=512 * 1024 ** 2, eviction_policy='least-recently-used')
 background_callback_manager = DiskcacheManager(cache)
 
-conn = sqlite3.connect('../stock_prices.db', check_same_thread=False)
+pool = ConnectionPool('../stock_prices.db')
 
-ticker_names = get_all_available_tickers(conn)
+ticker_names = get_all_available_tickers(pool.connection())
 xtb_available_tickers = pd.read_csv("../fundamentals/input/brokerage_available_stocks.csv")
 
 var_confidence_level = 0.95
+#Universe scans: small chunks so the first rows show up quickly, one worker per core by default
+scan_chunk_size = 50
+scan_workers = None
+#Points drawn in the price chart, roughly its width in pixels
+chart_points = 1000
 
 window_size = range(60, 180, 10)
 prediction_horizon = range(30, 360, 30)
@@ -30,6 +44,8 @@ app = Dash()
 app.layout = [
     html.H1(children='Stock dashboard', style={'textAlign': 'center'}),
     dcc.Dropdown(pd.Series(ticker_names), 'CRSP', id='dropdown-selection'),
+    #Only the selection is kept in the browser, the price frame itself stays in the server-side cache
+    dcc.Store(id='selected-prices'),
     dcc.RadioItems(id='broker',
                   options=[
                       {'label': 'Show all ', 'value': 'all'},
@@ -72,11 +88,20 @@ app.layout = [
 
         ], style={'flex': 1}),
     ], style={'display': 'flex', 'flexDirection': 'row'}),
-    dash_table.DataTable(id='table', page_size=10),
+    dash_table.DataTable(id='table',
+                         columns=[{'name': column, 'id': column} for column in page_columns],
+                         page_current=0,
+                         page_size=10,
+                         page_action='custom',
+                         sort_action='custom',
+                         sort_mode='single',
+                         filter_action='custom',
+                         filter_query=''),
     html.H2(children="GBM simulation"),
     html.Div(id="current-window-size"),
     html.Div(id="current-prediction-horizon"),
     html.Button(id="gbm-scan-button", children="Run GBM simulation over all stocks"),
+    html.Div(id="gbm-scan-progress"),
     dash_table.DataTable(id="gbm-scan-table", page_size=20, sort_action='native')
 ]
 
@@ -101,43 +126,80 @@ def update_current_prediction_horizon(prediction_horizon):
 def update_dropdown(selected_brokerage):
     return get_available_tickers(selected_brokerage)
 
+@cache.memoize(expire=cache_ttl)
+def cached_prices(ticker, version):
+    return load_prices(ticker, pool.connection())
+
+@cache.memoize(expire=cache_ttl)
+def cached_gbm_simulation(ticker, window_size, prediction_horizon, version):
+    close = cached_prices(ticker, version)['close'].iloc[-window_size:]
+    gbm_simulation = brownian_motion(close,
+                                     simulation_paths=2000,
+                                     window_size=window_size,
+                                     n_days=prediction_horizon,
+                                     terminal_only=True)
+    #Simulated prices are only drawn for comparison, VaR/CVaR come from the closed form
+    gbm_risk = gbm_var(close,
+                       window_size=window_size,
+                       n_days=prediction_horizon,
+                       confidence_level=var_confidence_level)
+    return gbm_simulation[:, -1], gbm_risk.to_dict()
+
 @callback(
-    Output('stock-main-chart', 'figure'),
+    Output('selected-prices', 'data'),
     Input('dropdown-selection', 'value')
 )
-def update_stock_main_chart(value):
-    dff = load_prices(value, conn).reset_index()
-    fig = px.line(dff, x='date', y='close')
-    fig.update_layout(transition_duration=500)
+def update_selected_prices(value):
+    selection = {'ticker': value, 'version': db_version(pool.connection())}
+    #Warms the cache once, so the callbacks triggered by the store do not all load the prices at the same time
+    cached_prices(selection['ticker'], selection['version'])
+    return selection
+
+@callback(
+    Output('stock-main-chart', 'figure'),
+    Input('selected-prices', 'data'),
+    Input('stock-main-chart', 'relayoutData')
+)
+def update_stock_main_chart(selection, relayout_data):
+    close = cached_prices(selection['ticker'], selection['version'])['close']
+    #Zooming redraws only the visible range, so it reaches full resolution once it spans fewer than chart_points days
+    x_range = zoomed_range(relayout_data) if dash.ctx.triggered_id == 'stock-main-chart' else None
+    if x_range is not None:
+        close = close.loc[x_range[0]:x_range[1]]
+    dates, close = downsample(close.index, close.to_numpy(), chart_points)
+    fig = px.line(x=dates, y=close, labels={'x': 'date', 'y': 'close'})
+    fig.update_layout(transition_duration=500, uirevision=selection['ticker'])
     return fig
 
+def zoomed_range(relayout_data):
+    if not relayout_data or relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    return relayout_data.get('xaxis.range')
+
 @callback(
     Output('stock-log-returns', 'figure'),
-    Input('dropdown-selection', 'value')
+    Input('selected-prices', 'data')
 )
-def update_stock_log_returns(value):
-    dff = load_prices(value, conn)
-    dff['log_returns'] = np.log(dff['close'] / dff['close'].shift(1)).dropna()
-    fig = px.histogram(dff, x='log_returns', nbins=100)
+def update_stock_log_returns(selection):
+    log_returns = stats_cache.log_returns(selection['ticker'], pool.connection())
+    fig = px.histogram(log_returns.to_frame('log_returns'), x='log_returns', nbins=100)
     fig.update_layout(transition_duration=500)
     return fig
 
 @callback(
     Output('gbm_var', 'figure'),
-    Input('dropdown-selection', 'value'),
+    Input('selected-prices', 'data'),
     Input('window-size-slider', 'value'),
     Input('prediction-horizon-slider', 'value')
 )
-def update_gbm_var(ticker_name, window_size, prediction_horizon):
-    dff = load_prices(ticker_name, conn)
-    gbm_simulation = brownian_motion(dff['close'],
-                                     simulation_paths=2000,
-                                     window_size=window_size,
-                                     n_days=prediction_horizon)
-    gbm_final_prices = gbm_simulation[:, -1]
-
-    initial_price = dff['close'].iloc[-1]
-    var = np.percentile(gbm_final_prices - initial_price, 100 * (1 - var_confidence_level))
+def update_gbm_var(selection, window_size, prediction_horizon):
+    gbm_final_prices, gbm_risk = cached_gbm_simulation(selection['ticker'], window_size, prediction_horizon,
+                                                       selection['version'])
+    initial_price = gbm_risk['current_price']
+    var = gbm_risk['var']
+    cvar = gbm_risk['cvar']
     fig = px.histogram(gbm_final_prices)
 
     fig.add_vline(
@@ -148,6 +210,14 @@ def update_gbm_var(ticker_name, window_size, prediction_horizon):
         annotation_position="top left"
     )
 
+    fig.add_vline(
+        x=initial_price + cvar,
+        line_dash="dot",
+        line_color="darkred",
+        annotation_text=f"CVaR (95%): {cvar:.2f}",
+        annotation_position="bottom left"
+    )
+
     fig.add_vline(
         x=initial_price,
         line_dash="solid",
@@ -161,14 +231,40 @@ def update_gbm_var(ticker_name, window_size, prediction_horizon):
 
 @callback(
     Output('table', 'data'),
-    Input('dropdown-selection', 'value')
+    Output('table', 'page_count'),
+    Output('table', 'page_current'),
+    Input('selected-prices', 'data'),
+    Input('table', 'page_current'),
+    Input('table', 'page_size'),
+    Input('table', 'sort_by'),
+    Input('table', 'filter_query')
 )
-def update_table(value):
-    dff = load_prices(value, conn).reset_index()
-    return dff.to_dict('records')
+def update_table(selection, page_current, page_size, sort_by, filter_query):
+    #A new ticker, sort or filter starts again from the first page
+    if 'table.page_current' not in dash.ctx.triggered_prop_ids:
+        page_current = 0
+    #Only the requested page is read and sent, sorting and filtering run in SQL
+    page, row_count = load_price_page(selection['ticker'], pool.connection(),
+                                      page_current, page_size, sort_by, filter_query)
+    page_count = max(math.ceil(row_count / page_size), 1)
+    if page_current >= page_count:
+        page_current = page_count - 1
+        page, row_count = load_price_page(selection['ticker'], pool.connection(),
+                                          page_current, page_size, sort_by, filter_query)
+    return page.to_dict('records'), page_count, page_current
+
+def scan_rows(gbm_risk):
+    return [{
+        'Ticker': row.ticker,
+        'Current close price': round(row.current_price, 2),
+        'Avg simulated price': round(row.expected_price, 2),
+        'VaR 5% (abs)': row.var,
+        'VaR (%)': (row.var / row.current_price) * 100
+    } for row in gbm_risk.itertuples() if np.isfinite(row.var)]
 
 @callback(
     Output('gbm-scan-table', 'data'),
+    Output('gbm-scan-progress', 'children'),
     Input('gbm-scan-button', 'n_clicks'),
     State('window-size-slider', 'value'),
     State('prediction-horizon-slider', 'value'),
@@ -177,39 +273,34 @@ def update_table(value):
     manager=background_callback_manager,
     running=[
         (Output("gbm-scan-button", "disabled"), True, False),
+    ],
+    progress=[Output('gbm-scan-table', 'data'), Output('gbm-scan-progress', 'children')],
+    #Results of a scan no longer match the settings once they change, so the running scan is stopped
+    cancel=[
+        Input('window-size-slider', 'value'),
+        Input('prediction-horizon-slider', 'value'),
+        Input('broker', 'value')
     ]
 )
-def update_clicks(n_clicks, window_size, prediction_horizon, selected_brokerage):
+def update_clicks(set_progress, n_clicks, window_size, prediction_horizon, selected_brokerage):
     if not n_clicks:
-        return dash.no_update
+        return dash.no_update, dash.no_update
     tickers_to_scan = get_available_tickers(selected_brokerage)
 
+    #Chunks are evaluated on a process pool and each finished chunk is pushed to the table right away
     simulation_results = []
+    scanned = 0
+    for gbm_risk in iter_scan(pool.db_path, tickers_to_scan, var_scan,
+                              workers=scan_workers,
+                              chunk_size=scan_chunk_size,
+                              window_size=window_size,
+                              n_days=prediction_horizon,
+                              confidence_level=var_confidence_level):
+        simulation_results += scan_rows(gbm_risk)
+        scanned += len(gbm_risk)
+        set_progress((simulation_results, f"Scanned {scanned}/{len(tickers_to_scan)} tickers"))
 
-    for ticker_name in tickers_to_scan:
-        prices = load_prices(ticker_name, conn)
-        close_prices = prices['close']
-        gbm = brownian_motion(
-            simulation_paths=2000,
-            prices = close_prices,
-            n_days = prediction_horizon,
-            window_size=window_size
-        )
-        gbm_final_prices = gbm[:, -1]
-        current_close_price = close_prices.iloc[-1]
-        gbm_mean = np.mean(gbm_final_prices)
-        var = np.percentile(gbm_final_prices - current_close_price, 100 * (1 - var_confidence_level))
-        var_percent = (var / current_close_price) * 100
-
-        simulation_results.append({
-            'Ticker': ticker_name,
-            'Current close price': round(current_close_price, 2),
-            'Avg simulated price': round(gbm_mean, 2),
-            'VaR 5% (abs)': var,
-            'VaR (%)': var_percent
-        })
-
-    return simulation_results
+    return simulation_results, f"Scanned {scanned}/{len(tickers_to_scan)} tickers"
 
 
 def get_available_tickers(selected_brokerage):
@@ -1,17 +1,27 @@
 import backtrader as bt
-import sqlite3
 import pandas as pd
+import numpy as np
 from utils.load_stock import load_prices
 from utils.load_stock import load_ranks
+from utils import stats_cache
+from utils.connection_pool import ConnectionPool
 
-#SQL connection
-conn = sqlite3.connect("../stock_prices.db")
+#SQL connection; the pool opens a new handle in every process, so forked sweep workers never share
+#the parent's SQLite connection
+pool = ConnectionPool("../stock_prices.db")
 #Get data
-stock_prices = load_prices("CRSP", conn)
+stock_prices = load_prices("CRSP", pool.connection())
+
+def rank_cumsum(ticker, rank_mapping):
+    stock_ranks = load_ranks(ticker, pool.connection(), columns=['rank'])
+    rank_num = stock_ranks['rank'].map(rank_mapping).dropna()
+    return rank_num.index.to_numpy(dtype='datetime64[ns]'), \
+        np.concatenate(([0.0], np.cumsum(rank_num.to_numpy(dtype='float64'))))
 
 class RankSMA(bt.Indicator):
     lines = ('rank_sma',)
     params = (
+        ('ticker', None),
         ('window_size_months', 3),
         ('hold_value', 0.0),
         ('sell_value', -1.0),
@@ -22,17 +32,32 @@ class RankSMA(bt.Indicator):
 
     def __init__(self):
         default_rank_mapping = {'Hold': self.params.hold_value, 'Sell': self.params.sell_value, 'Strong Sell': self.params.strong_sell, 'Buy': self.params.buy, 'Strong Buy': self.params.strong_buy}
-        self.stock_ranks = load_ranks("CRSP", conn)
-        self.stock_ranks['rank_num'] = self.stock_ranks['rank'].map(default_rank_mapping)
-        pass
+        ticker = self.params.ticker or self.data._name
+        if not ticker:
+            raise ValueError("RankSMA needs the ticker param or a data feed added with name=<ticker>")
+        #Ranks are sorted by date, so any window is a pair of searchsorted bounds on a cumulative sum
+        self.rank_dates, self.rank_cumsum = stats_cache.cached(ticker, 'rank_cumsum', pool.connection(),
+                                                               lambda: rank_cumsum(ticker, default_rank_mapping),
+                                                               rank_mapping=default_rank_mapping)
+
+    def rank_mean(self, tick_dates):
+        #Mean of the ranks dated strictly between tick_date - window_size_months and tick_date
+        tick_dates = pd.DatetimeIndex(tick_dates)
+        start_dates = tick_dates - pd.DateOffset(months=self.params.window_size_months)
+        first = np.searchsorted(self.rank_dates, start_dates.to_numpy(dtype='datetime64[ns]'), side='right')
+        last = np.searchsorted(self.rank_dates, tick_dates.to_numpy(dtype='datetime64[ns]'), side='left')
+        with np.errstate(invalid='ignore'):
+            return (self.rank_cumsum[last] - self.rank_cumsum[first]) / (last - first)
 
     def next(self):
-        tick_date = pd.to_datetime(self.data.datetime.date(0))
-        start_date = tick_date - pd.DateOffset(months=self.params.window_size_months)
-        ranks = self.stock_ranks[(self.stock_ranks.index < tick_date)
-                                 & (self.stock_ranks.index > start_date)]
-        rank_avg = ranks['rank_num'].mean()
-        self.lines.rank_sma[0] = rank_avg
+        self.lines.rank_sma[0] = self.rank_mean([self.data.datetime.date(0)])[0]
+
+    def once(self, start, end):
+        tick_dates = [bt.num2date(tick).date() for tick in self.data.datetime.array[start:end]]
+        rank_avg = self.rank_mean(tick_dates)
+        rank_sma = self.lines.rank_sma.array
+        for i, bar in enumerate(range(start, end)):
+            rank_sma[bar] = rank_avg[i]
 
 
 class RankStrategy(bt.Strategy):
@@ -52,18 +77,15 @@ class RankStrategy(bt.Strategy):
             if self.ranks[0] < self.params.sell_signal_threshold:
                 self.sell()
 
-feed_prices = bt.feeds.PandasData(dataname=stock_prices)
-cerebro = bt.Cerebro()
-cerebro.adddata(feed_prices)
-cerebro.addstrategy(RankStrategy)
-cerebro.broker.setcash(10000)
-cerebro.broker.setcommission(0.001)
-cerebro.addsizer(bt.sizers.AllInSizerInt)
-
-
-cerebro.run()
-cerebro.plot()
-
-
+if __name__ == '__main__':
+    feed_prices = bt.feeds.PandasData(dataname=stock_prices)
+    cerebro = bt.Cerebro()
+    cerebro.adddata(feed_prices, name="CRSP")
+    cerebro.addstrategy(RankStrategy)
+    cerebro.broker.setcash(10000)
+    cerebro.broker.setcommission(0.001)
+    cerebro.addsizer(bt.sizers.AllInSizerInt)
 
 
+    cerebro.run()
+    cerebro.plot()
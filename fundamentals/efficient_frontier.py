@@ -4,6 +4,10 @@ import pandas as pd
 import numpy as np
 from pylab import mpl, plt
 import polars as pl
+from utils.load_stock import load_prices, load_ranks
+from utils import stats_cache
+from fundamentals.mean_variance import efficient_frontier, max_sharpe_weights_batch
+from fundamentals.rolling_covariance import rolling_covariance
 
 #Plotting settings
 plt.style.use('seaborn-v0_8')
@@ -15,19 +19,14 @@ conn = sqlite3.connect("../stock_prices.db")
 #Utils
 default_rank_mapping = { 'Hold': 0, 'Sell': -1, 'Strong Sell': -3, 'Buy': 1, 'Strong Buy': 3}
 
-def prepare_data(ticker, conn, rank_mapping=default_rank_mapping):
-    stock_ranks = pd.read_sql(f'SELECT date, rank FROM {ticker}_ranks', conn)
-    stock_prices = pd.read_sql(f'SELECT * FROM {ticker}_prices', conn)
-
+def rolling_rank_stats(ticker, conn, rank_mapping=default_rank_mapping, period='9mo'):
+    stock_ranks = load_ranks(ticker, conn, columns=['rank']).reset_index()
     stock_ranks['rank_num'] = stock_ranks['rank'].map(rank_mapping)
-    stock_ranks_pl = pl.from_pandas(stock_ranks)
-    stock_prices_pl = pl.from_pandas(stock_prices)
-
-    stock_ranks_rolling = stock_ranks_pl \
+    return pl.from_pandas(stock_ranks) \
         .with_columns([
         pl.col("date").cast(pl.Date),
     ]) \
-        .rolling(index_column='date', period='9mo', closed='both') \
+        .rolling(index_column='date', period=period, closed='both') \
         .agg([
         pl.col("rank_num").sum().alias("rank_sum"),
         pl.col("rank_num").mean().alias("rank_mean"),
@@ -35,6 +34,13 @@ def prepare_data(ticker, conn, rank_mapping=default_rank_mapping):
         pl.col("rank_num").count().alias("rank_count"),
     ])
 
+def prepare_data(ticker, conn, rank_mapping=default_rank_mapping):
+    stock_ranks_rolling = stats_cache.cached(ticker, 'rolling_rank_stats', conn,
+                                             lambda: rolling_rank_stats(ticker, conn, rank_mapping),
+                                             rank_mapping=rank_mapping, period='9mo')
+    stock_prices = load_prices(ticker, conn).reset_index()
+    stock_prices_pl = pl.from_pandas(stock_prices)
+
     stock_result_pl = stock_prices_pl.with_columns([
         pl.col("date").cast(pl.Date)
     ]).join_asof(
@@ -51,78 +57,56 @@ def apply_strategy(stock_data):
     stock_data['strategy_log_return'] = stock_data['log_return'] * stock_data['positions']
     stock_data['strategy_result'] = np.exp(stock_data['strategy_log_return'].cumsum())
 
-def efficient_frontier(u, cov_matrix):
-    weights = np.ones(u.shape)
-    weights_candidates = np.random.dirichlet(weights, size=100)
-    Rp = weights_candidates @ u
-    Stdp = np.sqrt(np.sum(weights_candidates @ cov_matrix * weights_candidates, axis=1)).to_numpy()
-    Sharpe = Rp / Stdp
-    frontier_np = np.hstack((weights_candidates, Rp.reshape(-1,1), Stdp.reshape(-1,1), Sharpe.reshape(-1,1)))
-
-    frontier_df = pd.DataFrame(frontier_np)
-    column_names = {frontier_df.columns[-3]: 'Rp', frontier_df.columns[-2]: 'Stdp', frontier_df.columns[-1]: 'Sharpe'}
-    frontier_df.rename(columns=column_names, inplace=True)
-    return frontier_df
-
-crsp = prepare_data('CRSP', conn)
-crsp = crsp.set_index('date')
-apply_strategy(crsp)
-crsp_c = crsp.add_prefix('CRSP_')
-
-sbsw = prepare_data('SBSW', conn)
-sbsw = sbsw.set_index('date')
-apply_strategy(sbsw)
-sbsw_c = sbsw.add_prefix('SBSW_')
-
-ntla = prepare_data('NTLA', conn)
-ntla = ntla.set_index('date')
-apply_strategy(ntla)
-ntla_c = ntla.add_prefix('NTLA_')
-
-stock_data = pd.concat([crsp_c, ntla_c, sbsw_c], axis=1).dropna()
-cov_matrix = stock_data[['CRSP_rank_sum', 'SBSW_rank_sum', 'NTLA_rank_sum']].cov()
+tickers = ['CRSP', 'SBSW', 'NTLA']
 
-#Efficient frontier
-frontier = efficient_frontier(
-    stock_data[['CRSP_rank_mean', 'SBSW_rank_mean', 'NTLA_rank_mean']].iloc[-1].to_numpy(),
-    cov_matrix)
-
-def best_weights(row):
-    expected_return = row[['CRSP_rank_mean', 'SBSW_rank_mean', 'NTLA_rank_mean']].to_numpy()
-    frontier = efficient_frontier(
-        expected_return,
-        cov_matrix)
-    return pd.Series(frontier.loc[frontier['Sharpe'].idxmax(), [0,1,2]])
+ticker_data = {}
+for ticker in tickers:
+    ticker_data[ticker] = prepare_data(ticker, conn).set_index('date')
+    apply_strategy(ticker_data[ticker])
 
+stock_data = pd.concat([data.add_prefix(f'{ticker}_') for ticker, data in ticker_data.items()], axis=1).dropna()
+rank_mean_columns = [f'{ticker}_rank_mean' for ticker in tickers]
+strategy_columns = [f'{ticker}_strategy_log_return' for ticker in tickers]
+weight_columns = [f'{ticker}_weight' for ticker in tickers]
+#Walk-forward covariance: each date only sees the trailing year, shrunk towards the identity for stability
+cov_window = 252
+cov_matrices = rolling_covariance(stock_data[[f'{ticker}_rank_sum' for ticker in tickers]].to_numpy(),
+                                  cov_window,
+                                  shrinkage='ledoit-wolf')
 
-stock_data[['w1', 'w2', 'w3']] = stock_data.apply(best_weights, axis=1)
-stock_data['strategy_log_return_frontier'] = np.sum(stock_data[['w1', 'w2', 'w3']].to_numpy() * stock_data[['CRSP_strategy_log_return', 'SBSW_strategy_log_return', 'NTLA_strategy_log_return']], axis=1)
-stock_data['strategy_log_return_random'] = np.sum(np.array((0.333, 0.333, 0.333)) * stock_data[['CRSP_strategy_log_return', 'SBSW_strategy_log_return', 'NTLA_strategy_log_return']], axis=1)
+#Efficient frontier
+frontier = efficient_frontier(
+    stock_data[rank_mean_columns].iloc[-1].to_numpy(),
+    cov_matrices[-1],
+    long_only=True)
+
+#Nothing is held before the first full covariance window or on dates without a positive expected return
+has_cov = np.trace(np.nan_to_num(cov_matrices), axis1=1, axis2=2) > 0
+weights = np.zeros((len(stock_data), len(tickers)))
+weights[has_cov] = max_sharpe_weights_batch(stock_data[rank_mean_columns].to_numpy(dtype='float64')[has_cov],
+                                            cov_matrices[has_cov],
+                                            long_only=True)
+stock_data[weight_columns] = np.nan_to_num(weights)
+stock_data['strategy_log_return_frontier'] = np.sum(stock_data[weight_columns].to_numpy() * stock_data[strategy_columns], axis=1)
+stock_data['strategy_log_return_random'] = np.sum(np.full(len(tickers), 1 / len(tickers)) * stock_data[strategy_columns], axis=1)
 stock_data['strategy_frontier_result'] = np.exp(stock_data['strategy_log_return_frontier'].cumsum())
 stock_data['strategy_result'] = np.exp(stock_data['strategy_log_return_random'].cumsum())
 
 
 #Plotting
-plt.figure(figsize=(12,8))
-ax1 = plt.subplot(511)
-ax1.set_title("CRSP")
-crsp[['close', 'rank_mean']].plot(ax=ax1, secondary_y=['rank_mean'])
+plot_rows = len(tickers) + 2
+plt.figure(figsize=(12, 4 + 1.6 * len(tickers)))
+for i, ticker in enumerate(tickers, start=1):
+    ax = plt.subplot(plot_rows, 1, i)
+    ax.set_title(ticker)
+    ticker_data[ticker][['close', 'rank_mean']].plot(ax=ax, secondary_y=['rank_mean'])
 
-ax2 = plt.subplot(512)
-ax2.set_title("SBSW")
-sbsw[['close', 'rank_mean']].plot(ax=ax2, secondary_y=['rank_mean'])
+ax_weights = plt.subplot(plot_rows, 1, plot_rows - 1)
+stock_data[weight_columns].plot(ax=ax_weights)
+ax_weights.legend([f"{ticker} weight" for ticker in tickers])
 
-ax3 = plt.subplot(513)
-ax3.set_title("NTLA")
-ntla[['close', 'rank_mean']].plot(ax=ax3, secondary_y=['rank_mean'])
-
-ax4 = plt.subplot(514)
-stock_data[['w1', 'w2', 'w3']].plot(ax=ax4)
-ax4.legend(["CRSP weight", "SBSW weight", "NTLA weight"])
-
-ax5 = plt.subplot(515)
-stock_data[['strategy_frontier_result', 'strategy_result']].plot(ax=ax5)
-ax5.legend(["ROI - efficient frontier weights", "ROI - all weights equal"])
+ax_result = plt.subplot(plot_rows, 1, plot_rows)
+stock_data[['strategy_frontier_result', 'strategy_result']].plot(ax=ax_result)
+ax_result.legend(["ROI - efficient frontier weights", "ROI - all weights equal"])
 
 plt.show()
-
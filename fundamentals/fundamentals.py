@@ -2,6 +2,11 @@ import polars as pl
 import plotly.graph_objects as go
 import os
 
+from utils.downsample import downsample
+
+#Points written per chart series, None keeps the full history
+chart_points = 1000
+
 # Read files
 prices_df = pl.read_csv("input/prices.csv")
 income_df = pl.read_csv("input/income_statements.csv")
@@ -53,15 +58,15 @@ result_df = result_df.group_by("act_symbol")\
             #pl.col("ps").rolling_median(window_size=252 * 5, min_samples=1).alias("ps_5y_median")
         ]))
 
-def create_symbol_plots(symbol_df, symbol):
-    dates = symbol_df["date"].to_list()
-    market_cap = symbol_df["market_cap"].to_list()
-    market_cap_3y_median = symbol_df["market_cap_3y_median"].to_list()
-    market_cap_5y_median = symbol_df["market_cap_5y_median"].to_list()
+def create_symbol_plots(symbol_df, symbol, chart_points=chart_points):
+    dates = symbol_df["date"].to_numpy()
+    market_cap_dates, market_cap = downsample(dates, symbol_df["market_cap"].to_numpy(), chart_points)
+    median_3y_dates, market_cap_3y_median = downsample(dates, symbol_df["market_cap_3y_median"].to_numpy(), chart_points)
+    median_5y_dates, market_cap_5y_median = downsample(dates, symbol_df["market_cap_5y_median"].to_numpy(), chart_points)
 
     fig_mc = go.Figure()
     fig_mc.add_trace(go.Scatter(
-        x=dates,
+        x=market_cap_dates,
         y=market_cap,
         name="Market Cap",
         line=dict(color="#4cc9f0", width=2),
@@ -69,14 +74,14 @@ def create_symbol_plots(symbol_df, symbol):
         marker=dict(size=4)
     ))
     fig_mc.add_trace(go.Scatter(
-        x=dates,
+        x=median_3y_dates,
         y=market_cap_3y_median,
         name="3Y Median",
         line=dict(color="#f48c06", width=2, dash="dash"),
         opacity=0.7
     ))
     fig_mc.add_trace(go.Scatter(
-        x=dates,
+        x=median_5y_dates,
         y=market_cap_5y_median,
         name="5Y Median",
         line=dict(color="#2fb32f", width=2, dash="dot"),
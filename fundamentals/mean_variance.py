@@ -0,0 +1,141 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+
+#Mean-variance portfolio weights for N assets from expected returns mu (N,) and covariance cov (N, N).
+#Without constraints the solutions are closed form, solved through one Cholesky factorization of cov;
+#long_only=True restricts weights to [0, 1] summing to one and solves the quadratic programs with SLSQP
+
+
+def portfolio_performance(weights, mu, cov, risk_free=0.0):
+    weights = np.asarray(weights, dtype='float64')
+    expected_return = weights @ mu
+    std = np.sqrt(weights @ cov @ weights)
+    return expected_return, std, (expected_return - risk_free) / std
+
+
+def solve_long_only(objective, mu, constraints, start=None):
+    n = len(mu)
+    result = minimize(objective,
+                      np.full(n, 1.0 / n) if start is None else start,
+                      method='SLSQP',
+                      jac=True,
+                      bounds=[(0.0, None)] * n,
+                      constraints=constraints,
+                      options={'ftol': 1e-12, 'maxiter': 500})
+    return result.x
+
+
+def min_variance_weights(cov, long_only=False):
+    cov = np.asarray(cov, dtype='float64')
+    n = len(cov)
+    if not long_only:
+        weights = cho_solve(cho_factor(cov), np.ones(n))
+        return weights / weights.sum()
+    weights = solve_long_only(lambda w: (w @ cov @ w, 2 * cov @ w), np.zeros(n),
+                              [{'type': 'eq', 'fun': lambda w: w.sum() - 1, 'jac': lambda w: np.ones(n)}])
+    return np.clip(weights, 0, None) / np.clip(weights, 0, None).sum()
+
+
+#Tangency portfolio. Weights are NaN when no portfolio has a positive excess return
+def max_sharpe_weights(mu, cov, risk_free=0.0, long_only=False):
+    excess = np.asarray(mu, dtype='float64') - risk_free
+    cov = np.asarray(cov, dtype='float64')
+    n = len(excess)
+    if not long_only:
+        weights = cho_solve(cho_factor(cov), excess)
+        if weights.sum() <= 0:
+            return np.full(n, np.nan)
+        return weights / weights.sum()
+    if not (excess > 0).any():
+        return np.full(n, np.nan)
+    #Maximizing the Sharpe ratio over the simplex is the convex program min y'Σy s.t. excess'y = 1, y >= 0
+    #(Cornuejols & Tütüncü); the weights are y rescaled to sum to one
+    start = np.where(excess > 0, 1.0, 0.0) / np.where(excess > 0, excess, 0.0).sum()
+    y = solve_long_only(lambda y: (y @ cov @ y, 2 * cov @ y), excess,
+                        [{'type': 'eq', 'fun': lambda y: excess @ y - 1, 'jac': lambda y: excess}],
+                        start)
+    y = np.clip(y, 0, None)
+    return y / y.sum()
+
+
+#Long-only problems with at most this many assets are solved exactly by enumerating the supports
+max_enumeration_assets = 10
+
+
+def solve_stacked(cov, rhs):
+    #Solves cov x = rhs for every row of rhs (T, N), factorizing cov once when it is shared by all rows
+    if cov.ndim == 2:
+        return cho_solve(cho_factor(cov), rhs.T).T
+    return np.linalg.solve(cov, rhs[..., None])[..., 0]
+
+
+#Max-Sharpe weights for every row of mu (T, N) at once; cov is one (N, N) matrix shared by all rows or a
+#(T, N, N) stack, e.g. rolling covariances. Rows without a portfolio of positive excess return are NaN
+def max_sharpe_weights_batch(mu, cov, risk_free=0.0, long_only=False):
+    excess = np.asarray(mu, dtype='float64') - risk_free
+    cov = np.asarray(cov, dtype='float64')
+    t, n = excess.shape
+    if not long_only:
+        weights = solve_stacked(cov, excess)
+        totals = weights.sum(axis=1, keepdims=True)
+        return np.where(totals > 0, weights / np.where(totals > 0, totals, 1), np.nan)
+
+    if n > max_enumeration_assets:
+        return np.array([max_sharpe_weights(excess[i], cov if cov.ndim == 2 else cov[i], long_only=True)
+                         for i in range(t)])
+
+    #The long-only optimum is the unconstrained tangency portfolio of its own support, and the tangency
+    #portfolio of any support with non-negative weights is long-only, so the best feasible support is exact.
+    #Its squared Sharpe ratio is excess_S' Σ_S⁻¹ excess_S
+    best_squared_sharpe = np.zeros(t)
+    weights = np.full((t, n), np.nan)
+    for size in range(1, n + 1):
+        for support in itertools.combinations(range(n), size):
+            support = list(support)
+            sub_cov = cov[np.ix_(support, support)] if cov.ndim == 2 else cov[:, support][:, :, support]
+            sub_excess = excess[:, support]
+            y = solve_stacked(sub_cov, sub_excess)
+            squared_sharpe = (y * sub_excess).sum(axis=1)
+            better = (squared_sharpe > best_squared_sharpe) & (y >= -1e-12).all(axis=1)
+            if better.any():
+                best_squared_sharpe[better] = squared_sharpe[better]
+                support_weights = np.zeros((better.sum(), n))
+                support_weights[:, support] = np.clip(y[better], 0, None)
+                weights[better] = support_weights / support_weights.sum(axis=1, keepdims=True)
+    return weights
+
+
+#Frontier portfolios for target returns between the minimum-variance portfolio and the best single asset.
+#Returns one row per point with the weights in columns 0..N-1 followed by Rp, Stdp and Sharpe
+def efficient_frontier(mu, cov, points=50, risk_free=0.0, long_only=False):
+    mu = np.asarray(mu, dtype='float64')
+    cov = np.asarray(cov, dtype='float64')
+    n = len(mu)
+    min_variance = min_variance_weights(cov, long_only)
+    targets = np.linspace(min_variance @ mu, max(mu.max(), min_variance @ mu), points)
+    if not long_only:
+        #Two-fund theorem: every frontier portfolio is a combination of Σ⁻¹1 and Σ⁻¹mu
+        factor = cho_factor(cov)
+        inv_ones, inv_mu = cho_solve(factor, np.ones(n)), cho_solve(factor, mu)
+        a, b, c = inv_ones.sum(), inv_mu.sum(), mu @ inv_mu
+        d = a * c - b ** 2
+        weights = (np.outer(c - targets * b, inv_ones) + np.outer(targets * a - b, inv_mu)) / d
+    else:
+        weights = np.empty((points, n))
+        start = min_variance
+        for i, target in enumerate(targets):
+            start = solve_long_only(lambda w: (w @ cov @ w, 2 * cov @ w), mu,
+                                    [{'type': 'eq', 'fun': lambda w: w.sum() - 1, 'jac': lambda w: np.ones(n)},
+                                     {'type': 'eq', 'fun': lambda w, target=target: mu @ w - target, 'jac': lambda w: mu}],
+                                    start)
+            weights[i] = np.clip(start, 0, None) / np.clip(start, 0, None).sum()
+
+    frontier_df = pd.DataFrame(weights)
+    frontier_df['Rp'] = weights @ mu
+    frontier_df['Stdp'] = np.sqrt(np.einsum('ij,jk,ik->i', weights, cov, weights))
+    frontier_df['Sharpe'] = (frontier_df['Rp'] - risk_free) / frontier_df['Stdp']
+    return frontier_df
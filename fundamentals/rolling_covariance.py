@@ -0,0 +1,125 @@
+import numpy as np
+
+#Covariance matrices of an N-asset returns panel (T, N) at every step, updated from running sums in O(N²)
+#per step instead of being recomputed over the whole window. Steps are yielded as (t, cov) by the iter_*
+#generators or stacked into a (T, N, N) array, with NaN matrices before enough observations are available.
+#Rows containing a NaN are skipped
+
+
+def shrink_to_identity(cov, intensity):
+    #Convex combination of cov and the identity scaled by the average variance
+    target = np.trace(cov) / len(cov)
+    shrunk = (1 - intensity) * cov
+    shrunk[np.diag_indices_from(shrunk)] += intensity * target
+    return shrunk
+
+
+def ledoit_wolf_intensity(cov, n, fourth_moment):
+    #Ledoit & Wolf (2004) intensity towards the scaled identity from the biased covariance of n observations
+    #and fourth_moment = (1/n) Σ_k ||y_k||⁴ of the demeaned observations; norms are scaled by 1/N
+    size = len(cov)
+    target = np.trace(cov) / size
+    dispersion = (np.sum(cov ** 2) - 2 * target * np.trace(cov) + target ** 2 * size) / size
+    if dispersion <= 0:
+        return 0.0
+    sampling = (fourth_moment / size - np.sum(cov ** 2) / size) / n
+    return min(max(sampling, 0.0), dispersion) / dispersion
+
+
+def iter_rolling_covariance(returns, window, min_periods=None, shrinkage=None):
+    #shrinkage: None, a fixed intensity in [0, 1], or 'ledoit-wolf' to estimate it at every step
+    returns = np.asarray(returns, dtype='float64')
+    size = returns.shape[1]
+    min_periods = window if min_periods is None else max(min_periods, 2)
+    valid_rows = np.isfinite(returns).all(axis=1)
+
+    #Running sums over the rows in the window: Σx, Σxxᵀ and, for Ledoit-Wolf, Σ||x||², Σ||x||⁴ and Σ||x||²x
+    sum_x = np.zeros(size)
+    sum_xx = np.zeros((size, size))
+    sum_norm2 = 0.0
+    sum_norm4 = 0.0
+    sum_norm2_x = np.zeros(size)
+    count = 0
+    for t, row in enumerate(returns):
+        for sign, index in ((1, t), (-1, t - window)):
+            if index < 0 or not valid_rows[index]:
+                continue
+            x = returns[index]
+            norm2 = x @ x
+            sum_x += sign * x
+            sum_xx += sign * np.outer(x, x)
+            sum_norm2 += sign * norm2
+            sum_norm4 += sign * norm2 ** 2
+            sum_norm2_x += sign * norm2 * x
+            count += sign
+
+        if count < min_periods:
+            yield t, np.full((size, size), np.nan)
+            continue
+        mean = sum_x / count
+        biased = sum_xx / count - np.outer(mean, mean)
+        if shrinkage is None:
+            yield t, biased * count / (count - 1)
+        elif shrinkage == 'ledoit-wolf':
+            #Σ_k ||x_k - mean||⁴ expanded into the running sums
+            mean_norm2 = mean @ mean
+            fourth_moment = (sum_norm4
+                             - 4 * sum_norm2_x @ mean
+                             + 4 * mean @ sum_xx @ mean
+                             + 2 * mean_norm2 * sum_norm2
+                             - 4 * mean_norm2 * sum_x @ mean
+                             + count * mean_norm2 ** 2) / count
+            yield t, shrink_to_identity(biased, ledoit_wolf_intensity(biased, count, fourth_moment))
+        else:
+            yield t, shrink_to_identity(biased * count / (count - 1), shrinkage)
+
+
+def iter_ewm_covariance(returns, halflife=None, alpha=None, min_periods=2, shrinkage=None):
+    #Exponentially weighted mean and covariance, cov_t = (1 - alpha) (cov_t-1 + alpha d dᵀ) with d = x_t - mean_t-1;
+    #shrinkage can be a fixed intensity in [0, 1]
+    if alpha is None:
+        alpha = 1 - np.exp(np.log(0.5) / halflife)
+    returns = np.asarray(returns, dtype='float64')
+    size = returns.shape[1]
+    mean = np.zeros(size)
+    cov = np.zeros((size, size))
+    count = 0
+    for t, row in enumerate(returns):
+        if np.isfinite(row).all():
+            if count == 0:
+                mean = row.copy()
+            else:
+                deviation = row - mean
+                mean += alpha * deviation
+                cov = (1 - alpha) * (cov + alpha * np.outer(deviation, deviation))
+            count += 1
+        if count < min_periods:
+            yield t, np.full((size, size), np.nan)
+        elif shrinkage is None:
+            yield t, cov.copy()
+        else:
+            yield t, shrink_to_identity(cov, shrinkage)
+
+
+def stack(steps, length, size, dtype):
+    covariances = np.empty((length, size, size), dtype=dtype)
+    for t, cov in steps:
+        covariances[t] = cov
+    return covariances
+
+
+def rolling_covariance(returns, window, min_periods=None, shrinkage=None, dtype='float64'):
+    returns = np.asarray(returns, dtype='float64')
+    return stack(iter_rolling_covariance(returns, window, min_periods, shrinkage), *returns.shape, dtype)
+
+
+def ewm_covariance(returns, halflife=None, alpha=None, min_periods=2, shrinkage=None, dtype='float64'):
+    returns = np.asarray(returns, dtype='float64')
+    return stack(iter_ewm_covariance(returns, halflife, alpha, min_periods, shrinkage), *returns.shape, dtype)
+
+
+def covariance_to_correlation(covariances):
+    #Works on a single (N, N) matrix or a (T, N, N) stack
+    std = np.sqrt(np.diagonal(covariances, axis1=-2, axis2=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariances / (std[..., :, None] * std[..., None, :])
@@ -1,20 +1,137 @@
-import pandas as pd
+import argparse
+import os
 import sqlite3
+import time
+
+import pandas as pd
+
+from utils import price_store
+
+
+def prepare_ticker_tables(df_prices, df_ranks, conn):
+    for name, stock_data in df_prices.groupby('act_symbol'):
+        standarized_name = name.replace(',', '_')
+        stock_data.to_sql(f"{name}_prices", conn, if_exists='replace', index=False)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_prices_date_idx" ON "{name}_prices" (date)')
+
+    for name, stock_ranks in df_ranks.groupby('act_symbol'):
+        standarized_name = name.replace(',', '_')
+        stock_ranks.to_sql(f"{name}_ranks", conn, if_exists='replace', index=False)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_ranks_date_idx" ON "{name}_ranks" (date)')
+    conn.commit()
+
+
+def read_input_csv(path, columns, **kwargs):
+    #Symbols such as "NA" must not be parsed as missing values, and floats must round-trip
+    #exactly so that incremental refreshes do not see unchanged rows as corrected
+    return pd.read_csv(path, usecols=columns, dtype={'date': str, 'act_symbol': str},
+                       keep_default_na=False, na_values=[''], float_precision='round_trip',
+                       **kwargs)
+
+
+def chunk_rows_for(path, columns, memory_limit_mb):
+    sample = read_input_csv(path, columns, nrows=10_000)
+    row_bytes = sample.memory_usage(deep=True, index=False).sum() / max(len(sample), 1)
+    #Half of the budget for the parsed chunk, the rest for the rows handed to sqlite
+    return max(1_000, int(memory_limit_mb * 1024 ** 2 / 2 / row_bytes))
+
+
+def correction_cutoffs(watermarks, corrections_days):
+    #Rows dated after a symbol's cutoff and up to its watermark are re-checked for corrections
+    return {symbol: (pd.Timestamp(watermark) - pd.Timedelta(days=corrections_days)).strftime('%Y-%m-%d')
+            for symbol, watermark in watermarks.items()}
+
+
+def stream_csv(path, table, columns, conn, memory_limit_mb, watermarks=None, corrections_days=30):
+    #With watermarks only rows newer than the last stored date of their symbol, or within corrections_days
+    #before it, are loaded; the older history is assumed final and dropped before it reaches sqlite
+    chunk_rows = chunk_rows_for(path, columns, memory_limit_mb)
+    price_store.create_staging_table(conn, table)
+    cutoffs = None if watermarks is None else correction_cutoffs(watermarks, corrections_days)
+    start = time.perf_counter()
+    loaded = 0
+    new_rows = 0
+    checked_rows = 0
+    changes_before = conn.total_changes
+    for chunk in read_input_csv(path, columns, chunksize=chunk_rows):
+        chunk = chunk[columns]
+        if cutoffs is not None:
+            symbols = chunk['act_symbol']
+            last_dates = symbols.map(watermarks)
+            is_new = last_dates.isna() | (chunk['date'] > last_dates)
+            new_rows += int(is_new.sum())
+            staged_chunk = chunk[is_new | (chunk['date'] > symbols.map(cutoffs))]
+            checked_rows += len(staged_chunk) - int(is_new.sum())
+        else:
+            staged_chunk = chunk
+            new_rows += len(chunk)
+        with conn:
+            price_store.stage_rows(conn, table, columns, staged_chunk.itertuples(index=False, name=None))
+        loaded += len(chunk)
+        print(f"{table}: {loaded:,} rows read ({loaded / (time.perf_counter() - start):,.0f} rows/s)")
+    with conn:
+        price_store.merge_staging(conn, table, columns, skip_unchanged=watermarks is not None)
+    elapsed = time.perf_counter() - start
+    if watermarks is None:
+        print(f"{table}: {new_rows:,} rows in {elapsed:.1f}s ({loaded / elapsed:,.0f} rows/s)")
+    else:
+        #total_changes counts every staged row once and every merged row once more
+        corrected = conn.total_changes - changes_before - checked_rows - 2 * new_rows
+        print(f"{table}: {new_rows:,} new rows, {corrected:,} of {checked_rows:,} recent rows corrected "
+              f"in {elapsed:.1f}s ({loaded / elapsed:,.0f} rows/s)")
+    return loaded
+
 
-#Reading input data
-df_prices = pd.read_csv("fundamentals/input/prices.csv")
-df_ranks = pd.read_csv("fundamentals/input/ranks.csv")
+def refresh_table(path, table, columns, conn, memory_limit_mb, incremental, corrections_days=30):
+    stat = os.stat(path)
+    manifest = price_store.read_manifest(conn, path)
+    if incremental and manifest is not None and manifest[:2] == (stat.st_size, stat.st_mtime_ns):
+        print(f"{table}: {path} unchanged since last refresh (watermark {manifest[3]}), skipping")
+        return
+    watermarks = price_store.load_watermarks(conn, table) if incremental else None
+    rows = stream_csv(path, table, columns, conn, memory_limit_mb, watermarks, corrections_days)
+    price_store.write_manifest(conn, path, table, stat.st_size, stat.st_mtime_ns, rows)
 
-conn = sqlite3.connect("stock_prices.db")
 
-for name, stock_data in df_prices.groupby('act_symbol'):
-    standarized_name = name.replace(',', '_')
-    stock_data.to_sql(f"{name}_prices", conn, if_exists='replace', index=False)
+def prepare_price_store(prices_path, ranks_path, conn, memory_limit_mb=256, incremental=False, corrections_days=30):
+    conn.execute(f"PRAGMA cache_size=-{memory_limit_mb * 1024 // 2}")
+    price_store.create_price_store(conn, replace=not incremental)
+    refresh_table(prices_path, 'prices', price_store.price_columns, conn, memory_limit_mb, incremental,
+                  corrections_days)
+    refresh_table(ranks_path, 'ranks', price_store.rank_columns, conn, memory_limit_mb, incremental,
+                  corrections_days)
+    price_store.create_indexes(conn)
 
-for name, stock_ranks in df_ranks.groupby('act_symbol'):
-    standarized_name = name.replace(',', '_')
-    stock_ranks.to_sql(f"{name}_ranks", conn, if_exists='replace', index=False)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load prices.csv and ranks.csv into the SQLite database")
+    parser.add_argument('--db', default="stock_prices.db")
+    parser.add_argument('--layout', choices=['tables', 'long'], default='tables',
+                        help="'tables': one table per ticker, 'long': single indexed prices/ranks tables")
+    parser.add_argument('--memory-limit-mb', type=int, default=256,
+                        help="approximate memory ceiling for the streaming 'long' ingestion")
+    parser.add_argument('--incremental', action='store_true',
+                        help="'long' layout only: add rows newer than the stored ones and upsert corrections "
+                             "instead of rebuilding the tables")
+    parser.add_argument('--corrections-days', type=int, default=30,
+                        help="with --incremental, stored rows up to this many days before a symbol's last date "
+                             "are compared with the source and corrected; older rows are left as they are")
+    args = parser.parse_args()
 
+    prices_path = "fundamentals/input/prices.csv"
+    ranks_path = "fundamentals/input/ranks.csv"
 
+    if args.incremental and args.layout != 'long':
+        parser.error("--incremental requires --layout long")
 
+    if args.layout == 'long':
+        conn = price_store.connect(args.db)
+        prepare_price_store(prices_path, ranks_path, conn, args.memory_limit_mb, args.incremental,
+                            args.corrections_days)
+    else:
+        #Reading input data
+        df_prices = pd.read_csv(prices_path)
+        df_ranks = pd.read_csv(ranks_path)
+        conn = sqlite3.connect(args.db)
+        prepare_ticker_tables(df_prices, df_ranks, conn)
+    conn.close()
@@ -1,9 +1,8 @@
-from stochastic.gbm_func import brownian_motion
 from utils.load_stock import load_prices,load_ranks
 import backtrader as bt
 import sqlite3
-import pandas as pd
 import numpy as np
+import scipy.stats as scs
 from utils.load_stock import load_prices
 from utils.load_stock import load_ranks
 
@@ -19,36 +18,86 @@ class GBMIndicator(bt.Indicator):
         ('high_percentile', 80), #80
         ('low_percentile', 20), #20
         ('rolling_window_size', 30),
-        ('simulation_paths', 500),
         ('prediction_horizon', 1/12)
     )
 
+    #Percentiles come from the closed-form lognormal terminal distribution (see gbm_func.gbm_percentiles).
+    #next() keeps running sums of the window's returns, O(1) per bar; once() computes all bars at once
+
     def __init__(self):
         self.addminperiod(self.params.rolling_window_size)
-        np.random.seed(42)
         self.dt = 1/252
         self.N = int(self.params.prediction_horizon/self.dt)
+        self.z_low, self.z_high = scs.norm.ppf([self.params.low_percentile / 100, self.params.high_percentile / 100])
+        self.returns_sum = 0.0
+        self.returns_sq_sum = 0.0
+
+    def terminal_prices(self, price, returns_sum, returns_sq_sum):
+        n = self.params.rolling_window_size - 1
+        mean = returns_sum / n * 252
+        std = np.sqrt(np.maximum(returns_sq_sum - returns_sum ** 2 / n, 0) / (n - 1) * 252)
+        horizon = self.N * self.dt
+        log_mean = np.log(price) + (mean - 0.5 * std ** 2) * horizon
+        log_std = std * np.sqrt(horizon)
+        return (np.exp(log_mean + log_std * self.z_high),
+                np.exp(log_mean + log_std * self.z_low),
+                price * np.exp(mean * horizon))
+
+    def nextstart(self):
+        closes = np.array(self.data.close.get(size=self.params.rolling_window_size))
+        returns = closes[1:] / closes[:-1] - 1
+        self.returns_sum = returns.sum()
+        self.returns_sq_sum = (returns ** 2).sum()
+        self.set_lines()
 
     def next(self):
-        rolling_window_data = pd.Series(self.data.close.get(size=self.params.rolling_window_size))
-        simulation = brownian_motion(rolling_window_data,
-                        self.params.simulation_paths,
-                        self.N,
-                        self.dt,
-                        self.params.rolling_window_size)
-        final_prices = simulation[:, -1]
-        percentiles = np.percentile(final_prices, [self.params.low_percentile, self.params.high_percentile])
-        p_low = percentiles[0]
-        p_high = percentiles[1]
+        window_size = self.params.rolling_window_size
+        new_return = self.data.close[0] / self.data.close[-1] - 1
+        old_return = self.data.close[-(window_size - 1)] / self.data.close[-window_size] - 1
+        self.returns_sum += new_return - old_return
+        self.returns_sq_sum += new_return ** 2 - old_return ** 2
+        self.set_lines()
+
+    def set_lines(self):
+        p_high, p_low, avg_price = self.terminal_prices(self.data.close[0], self.returns_sum, self.returns_sq_sum)
         self.lines.high_percentile[0] = p_high
         self.lines.low_percentile[0] = p_low
-        self.lines.avg_price[0] = final_prices.mean()
+        self.lines.avg_price[0] = avg_price
+
+    def once(self, start, end):
+        window_size = self.params.rolling_window_size
+        first = start - window_size + 1
+        closes = np.asarray(self.data.close.array[first:end])
+        returns = closes[1:] / closes[:-1] - 1
+        returns_cumsum = np.concatenate(([0.0], np.cumsum(returns)))
+        returns_sq_cumsum = np.concatenate(([0.0], np.cumsum(returns ** 2)))
+        #Bar i covers the returns of the window_size - 1 bars up to and including i
+        returns_sum = returns_cumsum[window_size - 1:] - returns_cumsum[:-(window_size - 1)]
+        returns_sq_sum = returns_sq_cumsum[window_size - 1:] - returns_sq_cumsum[:-(window_size - 1)]
+        p_high, p_low, avg_price = self.terminal_prices(closes[window_size - 1:], returns_sum, returns_sq_sum)
+
+        high_percentile = self.lines.high_percentile.array
+        low_percentile = self.lines.low_percentile.array
+        avg = self.lines.avg_price.array
+        for i, bar in enumerate(range(start, end)):
+            high_percentile[bar] = p_high[i]
+            low_percentile[bar] = p_low[i]
+            avg[bar] = avg_price[i]
 
 
 class GBMStrategy(bt.Strategy):
+    params = (
+        ('high_percentile', 80),
+        ('low_percentile', 20),
+        ('rolling_window_size', 30),
+        ('prediction_horizon', 1/12)
+    )
 
     def __init__(self):
-        self.gbm = GBMIndicator()
+        self.gbm = GBMIndicator(high_percentile=self.params.high_percentile,
+                                low_percentile=self.params.low_percentile,
+                                rolling_window_size=self.params.rolling_window_size,
+                                prediction_horizon=self.params.prediction_horizon)
         self.rsi = bt.talib.RSI(self.data, timeperiod=14)
 
     def next(self):
@@ -1,17 +1,124 @@
 import numpy as np
+import pandas as pd
+import scipy.stats as scs
 
 def brownian_motion(prices,
                     simulation_paths=1000,
                     n_days=252,
                     dt=1/252,
-                    window_size=30):
+                    window_size=30,
+                    terminal_only=False):
     returns_pct = prices.tail(window_size).pct_change().dropna()
     current_price = prices.iloc[-1]
     mean = returns_pct.mean() * 252
     std = returns_pct.std() * np.sqrt(252)
 
-    dW = np.random.normal(0, 1, (simulation_paths, n_days))
     drift = (mean - 0.5 * std ** 2) * dt
+    if terminal_only:
+        #The sum of n_days independent N(0, 1) increments is N(0, n_days): sample it directly
+        #and return a (simulation_paths, 1) array so that S[:, -1] keeps working
+        dW = np.random.normal(0, np.sqrt(n_days), (simulation_paths, 1))
+        return current_price * np.exp(drift * n_days + std * np.sqrt(dt) * dW)
+
+    dW = np.random.normal(0, 1, (simulation_paths, n_days))
     diffusion = std * np.sqrt(dt) * dW
     S = current_price * np.exp(np.cumsum(drift + diffusion, axis=1))
-    return S
\ No newline at end of file
+    return S
+
+def gbm_parameters(price_panel, window_size=30):
+    #Same estimates as brownian_motion, for every column of a dates x tickers panel at once.
+    #Each column uses its own last window_size valid prices, so tickers may end on different dates
+    values = np.asarray(price_panel, dtype='float64')
+    valid = ~np.isnan(values)
+    order = np.argsort(valid, axis=0, kind='stable')
+    window = np.take_along_axis(values, order, axis=0)[-window_size:]
+    returns_pct = window[1:] / window[:-1] - 1
+    counts = (~np.isnan(returns_pct)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(returns_pct, axis=0) / counts
+        variance = np.nansum((returns_pct - mean) ** 2, axis=0) / (counts - 1)
+    parameters = pd.DataFrame({
+        'current_price': window[-1],
+        'mean': mean * 252,
+        'std': np.sqrt(variance) * np.sqrt(252)
+    }, index=getattr(price_panel, 'columns', None))
+    return parameters
+
+def brownian_motion_batch(price_panel,
+                          simulation_paths=1000,
+                          n_days=252,
+                          dt=1/252,
+                          window_size=30,
+                          percentiles=np.arange(101),
+                          max_chunk_bytes=256 * 1024 ** 2):
+    #Samples the terminal prices of every ticker of the panel, a chunk of tickers per (tickers, paths) array,
+    #and returns the current price, mean and percentiles of the terminal prices per ticker
+    parameters = gbm_parameters(price_panel, window_size)
+    current_price = parameters['current_price'].to_numpy()
+    drift = ((parameters['mean'] - 0.5 * parameters['std'] ** 2) * dt).to_numpy()
+    volatility = (parameters['std'] * np.sqrt(dt)).to_numpy()
+
+    n_tickers = len(parameters)
+    #Only one (tickers, paths) array is alive per chunk: the draws are turned into prices in place and
+    #the percentiles partition that same array, so max_chunk_bytes bounds the peak memory
+    chunk_size = max(1, max_chunk_bytes // (simulation_paths * 8))
+    terminal_mean = np.full(n_tickers, np.nan)
+    terminal_percentiles = np.full((n_tickers, len(percentiles)), np.nan)
+    for start in range(0, n_tickers, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        final_prices = np.random.normal(0, np.sqrt(n_days), (len(current_price[chunk]), simulation_paths))
+        final_prices *= volatility[chunk, None]
+        final_prices += drift[chunk, None] * n_days
+        np.exp(final_prices, out=final_prices)
+        final_prices *= current_price[chunk, None]
+        terminal_mean[chunk] = final_prices.mean(axis=1)
+        terminal_percentiles[chunk] = np.percentile(final_prices, percentiles, axis=1, overwrite_input=True).T
+        #Released before the next chunk is drawn
+        del final_prices
+
+    result = pd.DataFrame(terminal_percentiles, index=parameters.index, columns=list(percentiles))
+    result.insert(0, 'terminal_mean', terminal_mean)
+    result.insert(0, 'current_price', current_price)
+    return result
+
+def gbm_terminal_distribution(price_panel, window_size=30, n_days=252, dt=1/252):
+    #Under GBM ln(S_T) is normal: returns its mean and std per ticker next to the estimated parameters
+    parameters = gbm_parameters(price_panel, window_size)
+    horizon = n_days * dt
+    with np.errstate(divide='ignore'):
+        parameters['log_mean'] = np.log(parameters['current_price']) \
+                                 + (parameters['mean'] - 0.5 * parameters['std'] ** 2) * horizon
+    parameters['log_std'] = parameters['std'] * np.sqrt(horizon)
+    return parameters
+
+def gbm_percentiles(prices, window_size=30, n_days=252, q=np.arange(101), dt=1/252):
+    #Exact terminal price percentiles (q in 0-100) without sampling; a Series gives an array
+    #like np.percentile, a dates x tickers panel gives a tickers x q frame
+    panel = prices.to_frame() if isinstance(prices, pd.Series) else prices
+    distribution = gbm_terminal_distribution(panel, window_size, n_days, dt)
+    z = scs.norm.ppf(np.asarray(q, dtype='float64') / 100)
+    with np.errstate(invalid='ignore'):
+        percentiles = np.exp(distribution['log_mean'].to_numpy()[:, None]
+                             + distribution['log_std'].to_numpy()[:, None] * z)
+    if isinstance(prices, pd.Series):
+        return percentiles[0]
+    return pd.DataFrame(percentiles, index=distribution.index, columns=list(np.atleast_1d(q)))
+
+def gbm_var(prices, window_size=30, n_days=252, confidence_level=0.95, dt=1/252):
+    #Closed-form VaR and CVaR of the terminal price change (negative numbers are losses),
+    #with the current and expected terminal price, per ticker
+    panel = prices.to_frame() if isinstance(prices, pd.Series) else prices
+    distribution = gbm_terminal_distribution(panel, window_size, n_days, dt)
+    alpha = 1 - confidence_level
+    z = scs.norm.ppf(alpha)
+    current_price = distribution['current_price']
+    expected_price = current_price * np.exp(distribution['mean'] * n_days * dt)
+    result = pd.DataFrame({
+        'current_price': current_price,
+        'expected_price': expected_price,
+        'var': np.exp(distribution['log_mean'] + distribution['log_std'] * z) - current_price,
+        'cvar': expected_price * scs.norm.cdf(z - distribution['log_std']) / alpha - current_price
+    })
+    if isinstance(prices, pd.Series):
+        return result.iloc[0]
+    return result
@@ -1,65 +1,157 @@
+import argparse
+import glob
 import math
-import sqlite3
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import numpy as np
 import pandas as pd
 
+from utils.connection_pool import ConnectionPool
 from utils.get_all_available_tickers import get_all_available_tickers
-from utils.load_stock import load_prices
-from gbm_func import brownian_motion
-
-available_stocks = pd.read_csv("../fundamentals/input/brokerage_available_stocks.csv")
-print(available_stocks)
-
-conn = sqlite3.connect('../stock_prices.db')
-
-ticker_names = get_all_available_tickers(conn)
-ticker_data = {}
-
-for ticker_name in ticker_names:
-    if available_stocks["act_symbol"].str.contains(ticker_name).any():
-        print(f"{ticker_name}: Loading prices")
-        prices = load_prices(ticker_name, conn)
-        close_prices = prices['close']
-        print(f"{ticker_name}: Simulating GBM")
-        gbm = brownian_motion(
-            simulation_paths=2000,
-            prices = close_prices,
-            n_days = 30,
-            window_size=180
-        )
-        current_price = close_prices.iloc[-1]
-        gbm_final_prices = gbm[:, -1]
-        gbm_percentiles = np.percentile(gbm_final_prices, np.arange(101))
-        ticker_data[ticker_name] = {
-            'current_price': current_price,
-            'gbm_percentiles': gbm_percentiles
-        }
-        print(f"{ticker_name}: Finished")
+from utils.load_stock import load_price_panel
+from utils.price_store import db_version
+from stochastic.gbm_func import brownian_motion_batch, gbm_parameters, gbm_percentiles, gbm_var
+
+#Read-only connections of a worker process, opened by init_worker
+pool = None
+
+def init_worker(db_path):
+    global pool
+    pool = ConnectionPool(db_path)
+
+def percentile_scan(tickers, window_size=180, n_days=30, percentile=20, method='analytic', simulation_paths=2000):
+    close_prices, _ = load_price_panel(tickers, pool.connection(), field='close', last_n=window_size)
+    if method == 'montecarlo':
+        gbm = brownian_motion_batch(close_prices,
+                                    simulation_paths=simulation_paths,
+                                    n_days=n_days,
+                                    window_size=window_size,
+                                    percentiles=[percentile])
+        current_price = gbm['current_price']
+        percentile_price = gbm[percentile]
     else:
-        print(f"{ticker_name} - skipping")
+        current_price = gbm_parameters(close_prices, window_size)['current_price']
+        percentile_price = gbm_percentiles(close_prices, window_size, n_days, [percentile])[percentile]
+    result = pd.DataFrame({
+        'ticker': close_prices.columns,
+        'current_price': current_price.to_numpy(),
+        'percentile_price': percentile_price.to_numpy()
+    })
+    result['pct_diff'] = (result['percentile_price'] - result['current_price']) / result['current_price'] * 100
+    return result
 
-conn.close()
+def var_scan(tickers, window_size=60, n_days=30, confidence_level=0.95):
+    close_prices, _ = load_price_panel(tickers, pool.connection(), field='close', last_n=window_size)
+    return gbm_var(close_prices,
+                   window_size=window_size,
+                   n_days=n_days,
+                   confidence_level=confidence_level).rename_axis('ticker').reset_index()
 
-diff_list = []
-for ticker_name, data in ticker_data.items():
-    current_price = data['current_price']
-    percentile_price = data['gbm_percentiles'][20]
+def iter_scan(db_path, tickers, scan_function=percentile_scan, workers=None, chunk_size=200, **params):
+    #Runs scan_function(chunk, **params) over chunks of tickers on a process pool and yields
+    #each chunk's result frame as soon as it is ready; closing the generator cancels pending chunks
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(db_path,))
+    try:
+        futures = [executor.submit(scan_function, tickers[i:i + chunk_size], **params)
+                   for i in range(0, len(tickers), chunk_size)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    pct_diff = (percentile_price - current_price) / current_price * 100
+def read_checkpoints(checkpoint_dir):
+    files = sorted(glob.glob(os.path.join(checkpoint_dir, '*.csv')))
+    if not files:
+        return pd.DataFrame(columns=['ticker', 'current_price', 'percentile_price', 'pct_diff'])
+    #Symbols such as "NA" must stay strings
+    return pd.concat([pd.read_csv(file, dtype={'ticker': str}, keep_default_na=False, na_values=[''])
+                      for file in files], ignore_index=True)
 
-    if not math.isfinite(pct_diff):
-        continue
+def write_result(result, path):
+    if path.endswith('.parquet'):
+        result.to_parquet(path, index=False)
+    else:
+        result.to_csv(path, index=False)
 
-    diff_list.append({
-        'ticker': ticker_name,
-        'current_price': current_price,
-        'percentile_price': percentile_price,
-        'pct_diff': pct_diff
-    })
+def reset_stale_checkpoints(checkpoint_dir, version):
+    #Checkpoints are only valid for the database they were computed from
+    version_path = os.path.join(checkpoint_dir, 'db_version')
+    stored_version = None
+    if os.path.exists(version_path):
+        with open(version_path) as file:
+            stored_version = file.read()
+    if stored_version != version:
+        stale_files = glob.glob(os.path.join(checkpoint_dir, '*.csv'))
+        if stale_files:
+            print(f"Database changed since the checkpoints were written, discarding {len(stale_files)} chunks")
+        for file in stale_files:
+            os.remove(file)
+        with open(version_path, 'w') as file:
+            file.write(version)
+
+def scan(db_path, tickers, output, checkpoint_dir, workers=None, chunk_size=200, **params):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    version_pool = ConnectionPool(db_path)
+    reset_stale_checkpoints(checkpoint_dir, str(db_version(version_pool.connection())))
+    version_pool.close_all()
+    done = read_checkpoints(checkpoint_dir)
+    done_tickers = set(done['ticker'])
+    pending = [ticker for ticker in tickers if ticker not in done_tickers]
+    print(f"{len(done_tickers)} tickers already scanned, {len(pending)} to go")
+
+    chunk_index = len(glob.glob(os.path.join(checkpoint_dir, '*.csv')))
+    scanned = 0
+    for result in iter_scan(db_path, pending, workers=workers, chunk_size=chunk_size, **params):
+        result.to_csv(os.path.join(checkpoint_dir, f"chunk_{chunk_index:05d}.csv"), index=False)
+        chunk_index += 1
+        scanned += len(result)
+        print(f"{scanned}/{len(pending)} tickers scanned")
+
+    results = read_checkpoints(checkpoint_dir)
+    results = results[results['ticker'].isin(set(tickers))]
+    results = results[results['pct_diff'].map(math.isfinite)].sort_values('pct_diff')
+    write_result(results, output)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scan tickers for their GBM terminal price percentile")
+    parser.add_argument('--db', default='../stock_prices.db')
+    parser.add_argument('--brokers-csv', default="../fundamentals/input/brokerage_available_stocks.csv",
+                        help="only scan symbols listed in this file; pass an empty string to scan all")
+    parser.add_argument('--window-size', type=int, default=180)
+    parser.add_argument('--n-days', type=int, default=30)
+    parser.add_argument('--percentile', type=float, default=20)
+    parser.add_argument('--method', choices=['analytic', 'montecarlo'], default='analytic')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--output', default='gbm_scan.csv', help=".csv or .parquet")
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help="defaults to a directory named after the scan parameters next to the output")
+    args = parser.parse_args()
+
+    main_pool = ConnectionPool(args.db)
+    ticker_names = get_all_available_tickers(main_pool.connection())
+    main_pool.close_all()
+
+    if args.brokers_csv:
+        available_stocks = pd.read_csv(args.brokers_csv, dtype={'act_symbol': str}, keep_default_na=False)
+        available_symbols = set(available_stocks['act_symbol'])
+        tickers_to_scan = [ticker_name for ticker_name in ticker_names if ticker_name in available_symbols]
+        print(f"{len(tickers_to_scan)} of {len(ticker_names)} tickers available at the broker")
+    else:
+        tickers_to_scan = ticker_names
 
+    checkpoint_dir = args.checkpoint_dir or \
+        f"{os.path.splitext(args.output)[0]}_w{args.window_size}_d{args.n_days}_p{args.percentile:g}_{args.method}.checkpoint"
 
-sorted_diff_list = sorted(diff_list, key=lambda x: x['pct_diff'], reverse=False)
+    results = scan(args.db, tickers_to_scan, args.output, checkpoint_dir,
+                   workers=args.workers,
+                   chunk_size=args.chunk_size,
+                   window_size=args.window_size,
+                   n_days=args.n_days,
+                   percentile=args.percentile,
+                   method=args.method)
 
-for item in sorted_diff_list:
-    print(f"{item['ticker']}: {item['pct_diff']:.2f}% (Percentile price: {item['percentile_price']:.2f}, Current: {item['current_price']:.2f})")
\ No newline at end of file
+    for item in results.itertuples():
+        print(f"{item.ticker}: {item.pct_diff:.2f}% (Percentile price: {item.percentile_price:.2f}, Current: {item.current_price:.2f})")
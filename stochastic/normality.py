@@ -1,45 +1,90 @@
-from stochastic.gbm_func import brownian_motion
+from utils.connection_pool import ConnectionPool
 from utils.get_all_available_tickers import get_all_available_tickers
-from utils.load_stock import load_prices,load_ranks
-import backtrader as bt
-import sqlite3
+from utils.load_stock import load_price_panel
+from utils import stats_cache
 import pandas as pd
 import numpy as np
-from utils.load_stock import load_prices
-from utils.load_stock import load_ranks
 import statsmodels.api as sm
 import scipy.stats as scs
 from pylab import plt
 
-#SQL Connect
-conn = sqlite3.connect("../stock_prices.db")
 
-#Prices
-stock_prices = load_prices("ZVV", conn)
-log_returns = np.log(stock_prices['close'] / stock_prices['close'].shift(1)).dropna()
+def log_returns_panel(price_panel):
+    return np.log(price_panel / price_panel.shift(1)).iloc[1:]
 
-print(f"Normal test: {scs.normaltest(log_returns)[1]}")
-sm.qqplot(log_returns, line='s')
-plt.show()
+def skew_z_score(skew, n):
+    #D'Agostino's transformation of the sample skewness, as in scipy.stats.skewtest
+    y = skew * np.sqrt(((n + 1) * (n + 3)) / (6.0 * (n - 2)))
+    beta2 = (3.0 * (n ** 2 + 27 * n - 70) * (n + 1) * (n + 3)) / ((n - 2.0) * (n + 5) * (n + 7) * (n + 9))
+    w2 = -1 + np.sqrt(2 * (beta2 - 1))
+    delta = 1 / np.sqrt(0.5 * np.log(w2))
+    alpha = np.sqrt(2.0 / (w2 - 1))
+    y = np.where(y == 0, 1, y)
+    return delta * np.log(y / alpha + np.sqrt((y / alpha) ** 2 + 1))
 
-available_stocks = pd.read_csv("../fundamentals/input/brokerage_available_stocks.csv")
+def kurtosis_z_score(kurtosis, n):
+    #Anscombe & Glynn's transformation of the sample (Pearson) kurtosis, as in scipy.stats.kurtosistest
+    expected = 3.0 * (n - 1) / (n + 1)
+    variance = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) * (n + 1.0) * (n + 3) * (n + 5))
+    x = (kurtosis + 3 - expected) / np.sqrt(variance)
+    sqrt_beta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * np.sqrt((6.0 * (n + 3) * (n + 5)) / (n * (n - 2) * (n - 3)))
+    a = 6.0 + 8.0 / sqrt_beta1 * (2.0 / sqrt_beta1 + np.sqrt(1 + 4.0 / (sqrt_beta1 ** 2)))
+    term1 = 1 - 2 / (9.0 * a)
+    denom = 1 + x * np.sqrt(2 / (a - 4.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term2 = np.sign(denom) * np.where(denom == 0.0, np.nan, ((1 - 2.0 / a) / np.abs(denom)) ** (1 / 3.0))
+    return (term1 - term2) / np.sqrt(2 / (9.0 * a))
 
-conn = sqlite3.connect('../stock_prices.db')
+#Normality tests for every column of a returns panel (dates x tickers) in one pass; missing values are
+#skipped per column. skew/kurtosis are the biased sample estimates (kurtosis in excess of 3), as scipy's defaults.
+#Columns with fewer than 8 returns, the minimum of scipy's normaltest, get NaN statistics
+def normality_screen(returns, sort_by='k2_pvalue'):
+    values = returns.to_numpy(dtype='float64')
+    valid = np.isfinite(values)
+    n = valid.sum(axis=0).astype('float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid, values, 0.0).sum(axis=0) / n
+        deviations = np.where(valid, values - mean, 0.0)
+        squared = deviations ** 2
+        m2 = squared.sum(axis=0) / n
+        m3 = (squared * deviations).sum(axis=0) / n
+        m4 = (squared ** 2).sum(axis=0) / n
+        skew = m3 / m2 ** 1.5
+        kurtosis = m4 / m2 ** 2 - 3
+        k2 = skew_z_score(skew, n) ** 2 + kurtosis_z_score(kurtosis, n) ** 2
+    jarque_bera = n / 6 * (skew ** 2 + kurtosis ** 2 / 4)
 
-all_tickers = get_all_available_tickers(conn)
+    enough = (n >= 8) & (m2 > 0)
+    result = pd.DataFrame({
+        'observations': n.astype('int64'),
+        'skew': np.where(enough, skew, np.nan),
+        'kurtosis': np.where(enough, kurtosis, np.nan),
+        'k2': np.where(enough, k2, np.nan),
+        'jarque_bera': np.where(enough, jarque_bera, np.nan)
+    }, index=returns.columns)
+    result['k2_pvalue'] = scs.chi2.sf(result['k2'], 2)
+    result['jb_pvalue'] = scs.chi2.sf(result['jarque_bera'], 2)
+    return result.sort_values(sort_by)
 
-ticker_data = []
 
-for ticker_name in all_tickers:
-    prices = load_prices(ticker_name, conn)
-    log_returns = np.log(prices['close'] / prices['close'].shift(1)).dropna()
-    norm_test = scs.normaltest(log_returns)[1]
-    ticker_data.append({
-        'ticker_name': ticker_name,
-        'norm_test_res': norm_test
-    })
+if __name__ == '__main__':
+    pool = ConnectionPool("../stock_prices.db")
+    conn = pool.connection()
 
-sorted_diff_list = sorted(ticker_data, key=lambda x: x['norm_test_res'], reverse=False)
+    #Screen in chunks of tickers so the full-history panel stays small
+    all_tickers = get_all_available_tickers(conn)
+    chunk_size = 500
+    screens = []
+    for offset in range(0, len(all_tickers), chunk_size):
+        close_prices, _ = load_price_panel(all_tickers[offset:offset + chunk_size], conn, field='close')
+        screens.append(normality_screen(log_returns_panel(close_prices)))
+    screen = pd.concat(screens).sort_values('k2_pvalue')
 
-for item in sorted_diff_list:
-    print(f"{item['ticker_name']}: {item['norm_test_res']:.5f}%")
\ No newline at end of file
+    for ticker_name, row in screen.iterrows():
+        print(f"{ticker_name}: K2 p-value {row['k2_pvalue']:.5f}, JB p-value {row['jb_pvalue']:.5f}, "
+              f"skew {row['skew']:.2f}, kurtosis {row['kurtosis']:.2f}")
+
+    #QQ plot of the least normal ticker
+    log_returns = stats_cache.log_returns(screen.index[0], conn)
+    sm.qqplot(log_returns, line='s')
+    plt.show()
@@ -1,8 +1,9 @@
 import backtrader as bt
 import sqlite3
+import numpy as np
 import pandas as pd
-from scipy.optimize import brute
-from scipy.optimize import fmin
+import talib
+from utils.backtest_sweep import memoize_indicator, run_sweep
 from utils.load_stock import load_prices
 
 #SQL connection
@@ -10,6 +11,51 @@ conn = sqlite3.connect("../stock_prices.db")
 #Get data
 stock_prices = load_prices("CRSP", conn)
 
+class CachedBBands(bt.Indicator):
+    lines = ('upperband', 'middleband', 'lowerband')
+    params = (
+        ('period', 20),
+        ('nbdevup', 2.0),
+        ('nbdevdn', 2.0),
+        ('matype', 0)
+    )
+
+    #Same bands as talib.BBANDS, but the moving average and standard deviation are memoized per
+    #(data, period, matype), so a parameter sweep only pays for them once per period
+
+    def __init__(self):
+        self.addminperiod(self.params.period)
+        self.bands = None
+
+    def compute_bands(self, memoize=True):
+        close = np.asarray(self.data.array, dtype='float64')
+        key = ('bbands', hash(close.tobytes()), self.params.period, self.params.matype)
+        compute = lambda: (
+            talib.MA(close, timeperiod=self.params.period, matype=self.params.matype),
+            talib.STDDEV(close, timeperiod=self.params.period, nbdev=1))
+        average, deviation = memoize_indicator(key, compute) if memoize else compute()
+        return (average + self.params.nbdevup * deviation,
+                average,
+                average - self.params.nbdevdn * deviation)
+
+    def next(self):
+        #With preload the data array holds every bar up front and the bands are computed once. Without it
+        #the array only holds the bars seen so far, so the bands are recomputed whenever it has grown
+        if self.bands is None or len(self.bands[0]) != len(self.data.array):
+            self.bands = self.compute_bands(memoize=self.bands is None)
+        bar = len(self) - 1
+        self.lines.upperband[0] = self.bands[0][bar]
+        self.lines.middleband[0] = self.bands[1][bar]
+        self.lines.lowerband[0] = self.bands[2][bar]
+
+    def once(self, start, end):
+        for line, band in zip((self.lines.upperband, self.lines.middleband, self.lines.lowerband),
+                              self.compute_bands()):
+            array = line.array
+            for bar in range(start, end):
+                array[bar] = band[bar]
+
+
 class BBandsStrategy(bt.Strategy):
     params = (
         ('period', 44),
@@ -24,11 +70,11 @@ class BBandsStrategy(bt.Strategy):
 
     def __init__(self):
         self.dataclose = self.datas[0].close
-        self.bbands = bt.talib.BBANDS(self.data.close,
-                                      timeperiod=self.params.period,
-                                      nbdevup=self.params.nbdevup,
-                                      nbdevdn=self.params.nbdevdn,
-                                      matype=self.params.matype)
+        self.bbands = CachedBBands(self.data.close,
+                                   period=self.params.period,
+                                   nbdevup=self.params.nbdevup,
+                                   nbdevdn=self.params.nbdevdn,
+                                   matype=self.params.matype)
         self.order = None
 
     def next(self):
@@ -61,22 +107,19 @@ def bbands_strategy(params):
     return cerebro
 
 
-def backtest_to_optimise(params):
-    results = bbands_strategy(params).run()
-    return -results[0].broker.getvalue()
-
-ranges = (
-    slice(10, 40, 1),
-    (1,3,0.1),
-    (1,3,0.1)
-)
+grid = {
+    'period': range(10, 40),
+    'nbdevup': np.round(np.arange(1, 3, 0.1), 1),
+    'nbdevdn': np.round(np.arange(1, 3, 0.1), 1)
+}
 
 if __name__ == '__main__':
-    result = brute(func=backtest_to_optimise,
-                   ranges=ranges,
-                   full_output=False,
-                   finish=fmin,
-                   workers=8)
+    results = run_sweep(BBandsStrategy, stock_prices, grid,
+                        data_name="CRSP",
+                        workers=8,
+                        results_path="bbands_sweep.csv")
+    best = results.loc[results['value'].idxmax()]
+    result = (int(best['period']), best['nbdevup'], best['nbdevdn'])
 
     print(result)
 
@@ -2,11 +2,10 @@ import math
 import sqlite3
 
 import numpy as np
-import pandas as pd
 from pylab import mpl, plt
 import talib
-import scipy.optimize as sco
 import backtrader as bt
+from utils.load_stock import load_prices
 
 print(talib.get_functions())
 #Plotting settings
@@ -17,7 +16,7 @@ mpl.rcParams['font.family'] = 'serif'
 conn = sqlite3.connect("../stock_prices.db")
 
 #Get data
-stock_prices = pd.read_sql(f'SELECT * FROM CRSP_prices', conn)
+stock_prices = load_prices("CRSP", conn).reset_index()
 
 def keltner(params, df):
     period, nbdevup, nbdevdn = params
@@ -36,6 +35,32 @@ def keltner(params, df):
     new_df['strategy_return'] = np.exp(new_df['strategy_log_return'].cumsum())
     return new_df
 
+def keltner_grid(close, periods, nbdevups, nbdevdns):
+    #Final strategy_return of keltner() for every (period, nbdevup, nbdevdn) without a DataFrame per point.
+    #The forward-filled position is 1 when the latest close below the lower band is more recent than the
+    #latest close above the upper band, -1 in the opposite case and 0 before any signal, so only the
+    #last-signal bar per multiplier is needed before broadcasting to (nbdevup, nbdevdn, bars)
+    close = np.asarray(close, dtype='float64')
+    bars = np.arange(len(close))
+    log_returns = np.log(close[1:] / close[:-1])
+    nbdevups = np.asarray(nbdevups, dtype='float64')
+    nbdevdns = np.asarray(nbdevdns, dtype='float64')
+    cube = np.empty((len(periods), len(nbdevups), len(nbdevdns)))
+    for i, period in enumerate(periods):
+        period = int(period)
+        average = talib.SMA(close, timeperiod=period)
+        deviation = talib.STDDEV(close, timeperiod=period, nbdev=1)
+        with np.errstate(invalid='ignore'):
+            sell = close > average + nbdevups[:, None] * deviation
+            buy = close < average - nbdevdns[:, None] * deviation
+        last_sell = np.maximum.accumulate(np.where(sell, bars, -1), axis=-1)
+        last_buy = np.maximum.accumulate(np.where(buy, bars, -1), axis=-1)
+        position = np.sign(last_buy[None, :, 1:] - last_sell[:, None, 1:]).astype('float64')
+        cube[i] = np.exp(position @ log_returns)
+    best = np.unravel_index(np.argmax(cube), cube.shape)
+    best_params = (int(periods[best[0]]), nbdevups[best[1]], nbdevdns[best[2]])
+    return cube, best_params
+
 def res(df):
     return -df['strategy_return'].iloc[-1]
 
@@ -43,7 +68,9 @@ def to_optimize(params):
     res_df = keltner(params, stock_prices)
     return res(res_df)
 
-best = sco.brute(to_optimize, (slice(2, 50, 1), slice(0.1,10,0.5), slice(0.1,10,0.5)), finish=None, disp=True)
+#Same grid as the former sco.brute(to_optimize, (slice(2, 50, 1), slice(0.1,10,0.5), slice(0.1,10,0.5)))
+nbdevs = np.arange(0.1, 10, 0.5)
+result_cube, best = keltner_grid(stock_prices['close'], np.arange(2, 50, 1), nbdevs, nbdevs)
 
 print(best)
 
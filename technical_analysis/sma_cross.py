@@ -2,32 +2,75 @@ import numpy as np
 import pandas as pd
 from pylab import mpl, plt
 
-#Reading input data
-df = pd.read_csv("../fundamentals/input/prices.csv")
+def rolling_means(values, valid, window):
+    #NaN-aware rolling mean over a dates x symbols array: NaN unless all window values are present
+    sums = np.vstack((np.zeros(values.shape[1]), np.cumsum(np.where(valid, values, 0), axis=0)))
+    counts = np.vstack((np.zeros(values.shape[1]), np.cumsum(valid, axis=0)))
+    means = np.full(values.shape, np.nan)
+    full = (counts[window:] - counts[:-window]) == window
+    means[window - 1:] = np.where(full, (sums[window:] - sums[:-window]) / window, np.nan)
+    return means
 
-#Pivoting and getting data
-df = df.pivot(index='date', columns='act_symbol', values='close')
-crsp_stock = df[['CRSP']].copy().dropna().rename(columns={'CRSP': 'price'})
-crsp_stock['SMA1'] = crsp_stock['price'].rolling(window=42).mean()
-crsp_stock['SMA2'] = crsp_stock['price'].rolling(window=252).mean()
-crsp_stock['positions'] = np.where(crsp_stock['SMA1'] > crsp_stock['SMA2'],1,0)
+def sma_crossover_scan(prices, window_pairs=((42, 252),)):
+    #Runs the SMA crossover of every (short, long) window pair on every column of a dates x symbols
+    #price frame at once; returns total return, annualised Sharpe and max drawdown per pair and symbol
+    values = prices.to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+    log_returns = np.full(values.shape, np.nan)
+    log_returns[1:] = np.log(values[1:] / values[:-1])
+    means = {window: rolling_means(values, valid, window) for window in {w for pair in window_pairs for w in pair}}
 
-crsp_stock['log_returns'] = np.log(crsp_stock['price'] / crsp_stock['price'].shift(1))
-crsp_stock['strategy_log_return'] = (crsp_stock['log_returns'] * crsp_stock['positions'])
-crsp_stock['strategy_return'] = np.exp(crsp_stock['strategy_log_return'].cumsum())
+    results = []
+    for short_window, long_window in window_pairs:
+        with np.errstate(invalid='ignore'):
+            positions = np.where(means[short_window] > means[long_window], 1, 0)
+        strategy_log_return = log_returns * positions
+        present = ~np.isnan(strategy_log_return)
+        days = present.sum(axis=0)
+        cumulative = np.nancumsum(strategy_log_return, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = cumulative[-1] / days
+            std = np.sqrt(np.nansum((strategy_log_return - mean) ** 2, axis=0) / (days - 1))
+            sharpe = np.where(std > 0, mean / std * np.sqrt(252), np.nan)
+        drawdown = 1 - np.exp(cumulative - np.maximum.accumulate(cumulative, axis=0))
+        results.append(pd.DataFrame({
+            'short_window': short_window,
+            'long_window': long_window,
+            'symbol': prices.columns,
+            'days': days,
+            'strategy_return': np.exp(cumulative[-1]),
+            'sharpe': sharpe,
+            'max_drawdown': np.where(days > 0, drawdown.max(axis=0), np.nan)
+        }))
+    return pd.concat(results, ignore_index=True).set_index(['short_window', 'long_window', 'symbol'])
 
-print(crsp_stock.describe())
+if __name__ == '__main__':
+    #Reading input data
+    df = pd.read_csv("../fundamentals/input/prices.csv")
 
-#Plotting
-plt.figure(figsize=(11,7))
-ax1 = plt.subplot(211)
-crsp_stock[['price', 'SMA1', 'SMA2', 'positions']].plot(ax=ax1, secondary_y='positions')
+    #Pivoting and getting data
+    df = df.pivot(index='date', columns='act_symbol', values='close')
+    crsp_stock = df[['CRSP']].copy().dropna().rename(columns={'CRSP': 'price'})
+    crsp_stock['SMA1'] = crsp_stock['price'].rolling(window=42).mean()
+    crsp_stock['SMA2'] = crsp_stock['price'].rolling(window=252).mean()
+    crsp_stock['positions'] = np.where(crsp_stock['SMA1'] > crsp_stock['SMA2'],1,0)
 
-#Strategy return
-ax2 = plt.subplot(212)
-crsp_stock[['strategy_return']].plot(ax=ax2)
-plt.show()
+    crsp_stock['log_returns'] = np.log(crsp_stock['price'] / crsp_stock['price'].shift(1))
+    crsp_stock['strategy_log_return'] = (crsp_stock['log_returns'] * crsp_stock['positions'])
+    crsp_stock['strategy_return'] = np.exp(crsp_stock['strategy_log_return'].cumsum())
 
+    print(crsp_stock.describe())
 
+    #Whole universe
+    universe = sma_crossover_scan(df, window_pairs=[(42, 252), (20, 100), (50, 200)])
+    print(universe.sort_values('sharpe', ascending=False).head(20))
 
+    #Plotting
+    plt.figure(figsize=(11,7))
+    ax1 = plt.subplot(211)
+    crsp_stock[['price', 'SMA1', 'SMA2', 'positions']].plot(ax=ax1, secondary_y='positions')
 
+    #Strategy return
+    ax2 = plt.subplot(212)
+    crsp_stock[['strategy_return']].plot(ax=ax2)
+    plt.show()
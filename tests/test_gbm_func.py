@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import scipy.stats as scs
+
+from stochastic.gbm_func import brownian_motion
+
+
+def sample_prices(seed=7, days=120):
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, days))))
+
+
+def test_terminal_only_matches_full_paths():
+    prices = sample_prices()
+
+    np.random.seed(0)
+    full_paths = brownian_motion(prices, simulation_paths=4000, n_days=30, window_size=60)
+    np.random.seed(1)
+    terminal = brownian_motion(prices, simulation_paths=4000, n_days=30, window_size=60, terminal_only=True)
+
+    assert terminal.shape == (4000, 1)
+    full_final, terminal_final = full_paths[:, -1], terminal[:, -1]
+    assert abs(terminal_final.mean() - full_final.mean()) < 0.01 * full_final.mean()
+    assert abs(terminal_final.std() - full_final.std()) < 0.05 * full_final.std()
+    assert scs.ks_2samp(terminal_final, full_final).pvalue > 0.01
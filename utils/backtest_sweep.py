@@ -0,0 +1,111 @@
+import itertools
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import backtrader as bt
+import pandas as pd
+
+#Feed rows shared by every backtest of a worker process, converted once by init_worker
+worker_rows = None
+worker_data_name = None
+
+#Per-process cache of indicator arrays, so grid points sharing e.g. a period reuse the same rolling stats
+indicator_cache = OrderedDict()
+indicator_cache_size = 256
+
+
+class PreparedData(bt.feed.DataBase):
+    #Replays (datetime, open, high, low, close, volume) tuples; unlike PandasData it does no
+    #per-cell DataFrame lookups, which otherwise dominate the cost of a short backtest
+    params = (('rows', None),)
+
+    def start(self):
+        super().start()
+        self.row_index = 0
+
+    def _load(self):
+        if self.row_index >= len(self.params.rows):
+            return False
+        dt, open_, high, low, close, volume = self.params.rows[self.row_index]
+        self.lines.datetime[0] = dt
+        self.lines.open[0] = open_
+        self.lines.high[0] = high
+        self.lines.low[0] = low
+        self.lines.close[0] = close
+        self.lines.volume[0] = volume
+        self.row_index += 1
+        return True
+
+
+def prepare_rows(stock_prices):
+    dates = [bt.date2num(date.to_pydatetime()) for date in stock_prices.index]
+    columns = [stock_prices[column].astype('float64').tolist() for column in ('open', 'high', 'low', 'close', 'volume')]
+    return list(zip(dates, *columns))
+
+
+#Workers are forked, so strategies and indicators must not reuse a sqlite3 connection opened in the parent;
+#reading through a utils.connection_pool.ConnectionPool gives every worker its own handle
+def init_worker(stock_prices, data_name=None):
+    global worker_rows, worker_data_name
+    worker_rows = prepare_rows(stock_prices)
+    worker_data_name = data_name
+    indicator_cache.clear()
+
+
+def memoize_indicator(key, compute):
+    if key in indicator_cache:
+        indicator_cache.move_to_end(key)
+        return indicator_cache[key]
+    value = compute()
+    indicator_cache[key] = value
+    if len(indicator_cache) > indicator_cache_size:
+        indicator_cache.popitem(last=False)
+    return value
+
+
+def parameter_grid(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def run_backtest(strategy, params, cash=10000, commission=0.001):
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(PreparedData(rows=worker_rows), name=worker_data_name)
+    cerebro.addstrategy(strategy, **params)
+    cerebro.broker.setcash(cash)
+    cerebro.broker.setcommission(commission)
+    cerebro.addsizer(bt.sizers.AllInSizerInt)
+    cerebro.run()
+    return cerebro.broker.getvalue()
+
+
+def run_batch(strategy, batch, cash, commission):
+    return [{**params, 'value': run_backtest(strategy, params, cash, commission)} for params in batch]
+
+
+#Backtests every combination of grid ({param: values}) and returns one row per combination.
+#The price frame is sent once to each worker process and batches of grid points are run per task.
+#With results_path, finished rows are appended to a CSV as they arrive and combinations already
+#present there are skipped, so an interrupted sweep resumes where it stopped
+def run_sweep(strategy, stock_prices, grid, data_name=None, workers=None, batch_size=16,
+              results_path=None, cash=10000, commission=0.001):
+    names = list(grid)
+    done = pd.read_csv(results_path) if results_path and os.path.exists(results_path) else pd.DataFrame(columns=[*names, 'value'])
+    done_keys = set(done[names].itertuples(index=False, name=None))
+    pending = [params for params in parameter_grid(grid) if tuple(params.values()) not in done_keys]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"Sweep: {len(done_keys)} grid points already done, {len(pending)} to run")
+
+    results = [done] if len(done) else []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(stock_prices, data_name)) as executor:
+        futures = [executor.submit(run_batch, strategy, batch, cash, commission) for batch in batches]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            batch_results = pd.DataFrame(future.result())
+            if results_path:
+                batch_results.to_csv(results_path, mode='a', index=False,
+                                     header=not os.path.exists(results_path))
+            results.append(batch_results)
+            print(f"Sweep: {finished}/{len(batches)} batches finished")
+    return pd.concat(results, ignore_index=True) if results else done
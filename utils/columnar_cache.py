@@ -0,0 +1,88 @@
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from utils.price_store import database_path, db_version
+
+#Per-ticker Arrow IPC files stored next to the database: <db>.columnar/<table>/<ticker>.arrow
+#Files are uncompressed so they can be memory-mapped and read without copying
+
+
+def cache_path(ticker, table, conn):
+    path = database_path(conn)
+    if pa is None or path is None:
+        return None
+    return os.path.join(f"{path}.columnar", table, f"{ticker.replace(os.sep, '_')}.arrow")
+
+
+def read_table(path, version):
+    if not os.path.exists(path):
+        return None
+    try:
+        arrow_table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+    metadata = arrow_table.schema.metadata or {}
+    if metadata.get(b'source_version') != version.encode():
+        return None
+    return arrow_table
+
+
+def to_arrow(frame, version):
+    arrow_table = pa.Table.from_pandas(frame.sort_index().reset_index(), preserve_index=False)
+    return arrow_table.replace_schema_metadata({b'source_version': version.encode()})
+
+
+def write_table(path, arrow_table):
+    #Threads of one process may rebuild the same file concurrently, so every writer gets its own temp file.
+    #Returns False when the directory next to the database cannot be written
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+                writer.write_table(arrow_table)
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+#Serves a ticker from its Arrow file, rebuilding it with read_sql(ticker, conn) when the database changed.
+#Returns None when the cache cannot be used (pyarrow missing, in-memory database or unwritable cache directory)
+def load(ticker, table, conn, read_sql, columns=None, start=None, end=None, last_n=None):
+    path = cache_path(ticker, table, conn)
+    version = db_version(conn) if path is not None else None
+    if version is None:
+        return None
+    arrow_table = read_table(path, version)
+    if arrow_table is None:
+        fresh_table = to_arrow(read_sql(ticker, conn), version)
+        if not write_table(path, fresh_table):
+            return None
+        #A concurrent refresh may already have replaced the file; the frame just read is as good
+        arrow_table = read_table(path, version)
+        if arrow_table is None:
+            arrow_table = fresh_table
+    if start is not None or end is not None:
+        #Rows are sorted by date, so the range is a zero-copy slice
+        dates = arrow_table.column('date').to_numpy()
+        first = 0 if start is None else np.searchsorted(dates, np.datetime64(start), side='left')
+        last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end), side='right')
+        arrow_table = arrow_table.slice(first, max(last - first, 0))
+    if last_n is not None:
+        arrow_table = arrow_table.slice(max(arrow_table.num_rows - last_n, 0))
+    if columns is not None:
+        arrow_table = arrow_table.select(['date', *columns])
+    frame = arrow_table.to_pandas(split_blocks=True)
+    return frame.set_index('date')
@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+
+#Read-only SQLite handles, one per thread and process, so callbacks and workers can read in parallel.
+#mmap_size lets every handle read pages straight from the OS page cache; SQLite's own shared-cache mode
+#is opt-in because it uses table-level locking that serializes readers on busy tables
+class ConnectionPool:
+    def __init__(self, db_path, mmap_size=256 * 1024 ** 2, shared_cache=False):
+        self.db_path = os.path.abspath(db_path)
+        self.mmap_size = mmap_size
+        self.shared_cache = shared_cache
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connect(self):
+        uri = f"file:{pathname2url(self.db_path)}?mode=ro"
+        if self.shared_cache:
+            uri += "&cache=shared"
+        #Each handle is only used by its own thread; close_all may close it from another one
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def connection(self):
+        #A forked worker inherits the parent's thread-local handle, which must not be reused
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = self.connect()
+            self._local.pid = os.getpid()
+            with self._lock:
+                self._connections.append((self._local.pid, self._local.conn))
+        return self._local.conn
+
+    def close_all(self):
+        with self._lock:
+            pid = os.getpid()
+            for owner, conn in self._connections:
+                if owner == pid:
+                    conn.close()
+            self._connections = []
+        self._local = threading.local()
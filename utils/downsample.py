@@ -0,0 +1,70 @@
+import numpy as np
+
+#Reduces a series to about as many points as a chart has horizontal pixels before it is sent to the browser.
+#'lttb' (Largest-Triangle-Three-Buckets) keeps the visual shape of a line, 'minmax' keeps the extremes of
+#every bucket. Both return indices into the input, so several arrays can be reduced the same way
+
+
+def lttb_indices(x, y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    #First and last points are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    x_cumsum = np.concatenate(([0.0], np.cumsum(x)))
+    y_cumsum = np.concatenate(([0.0], np.cumsum(y)))
+    #Each bucket is compared against the average point of the bucket that follows it
+    next_x = np.append(((x_cumsum[ends] - x_cumsum[starts]) / (ends - starts))[1:], x[-1])
+    next_y = np.append(((y_cumsum[ends] - y_cumsum[starts]) / (ends - starts))[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    anchor = 0
+    #The point picked in a bucket depends on the previous pick, so only the inside of a bucket is vectorized
+    for bucket, (start, end) in enumerate(zip(starts, ends)):
+        area = np.abs((x[anchor] - next_x[bucket]) * (y[start:end] - y[anchor])
+                      - (x[anchor] - x[start:end]) * (next_y[bucket] - y[anchor]))
+        anchor = start + np.argmax(area)
+        selected[bucket + 1] = anchor
+    return selected
+
+
+def minmax_indices(y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    #Two points per bucket, plus the first and last point
+    size = -(-n // ((n_out - 2) // 2))
+    buckets = -(-n // size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    rows = padded.reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    selected = np.concatenate(([0, n - 1],
+                               offsets + np.nanargmin(rows, axis=1),
+                               offsets + np.nanargmax(rows, axis=1)))
+    return np.unique(selected)
+
+
+def as_float(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return values.astype(np.float64)
+
+
+#Returns (x, y) reduced to at most n_out points; missing y values are dropped first.
+#n_out=None keeps every point
+def downsample(x, y, n_out=1000, method='lttb'):
+    x, y = np.asarray(x), as_float(y)
+    valid = np.flatnonzero(np.isfinite(y))
+    if n_out is None:
+        return x[valid], y[valid]
+    if method == 'lttb':
+        indices = lttb_indices(as_float(x[valid]), y[valid], n_out)
+    elif method == 'minmax':
+        indices = minmax_indices(y[valid], n_out)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    return x[valid[indices]], y[valid[indices]]
@@ -1,5 +1,11 @@
+from utils.price_store import has_price_store
+
+
 def get_all_available_tickers(sql_conn):
     cursor = sql_conn.cursor()
+    if has_price_store(sql_conn):
+        cursor.execute("SELECT DISTINCT act_symbol FROM prices ORDER BY act_symbol;")
+        return [row[0] for row in cursor.fetchall()]
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     tables = cursor.fetchall()
-    return list(map(lambda x: x[0].removesuffix('_prices'), filter(lambda x: x[0].endswith('_prices'), tables)))
\ No newline at end of file
+    return list(map(lambda x: x[0].removesuffix('_prices'), filter(lambda x: x[0].endswith('_prices'), tables)))
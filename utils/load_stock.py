@@ -1,15 +1,158 @@
+import re
 import sqlite3
 import pandas as pd
 
-def load_prices(ticker, sql_conn):
-    stock_prices = pd.read_sql(f"SELECT * FROM '{ticker}_prices'", sql_conn)
-    stock_prices['date'] = pd.to_datetime(stock_prices['date'])
-    stock_prices.set_index('date', inplace=True)
+from utils import columnar_cache
+from utils.price_store import has_price_store
+
+def add_date_range(conditions, params, start=None, end=None):
+    if start is not None:
+        conditions.append("date >= ?")
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+    if end is not None:
+        conditions.append("date <= ?")
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+
+def build_query(ticker, table, sql_conn, columns=None, start=None, end=None, last_n=None):
+    selected = '*' if columns is None else ', '.join(f'"{column}"' for column in ['date', *columns])
+    if has_price_store(sql_conn):
+        source, conditions, params = table, ["act_symbol = ?"], [ticker]
+    else:
+        source, conditions, params = f'"{ticker}_{table}"', [], []
+    add_date_range(conditions, params, start, end)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    if last_n is None:
+        return f"SELECT {selected} FROM {source}{where} ORDER BY date", params
+    params.append(last_n)
+    return f"SELECT * FROM (SELECT {selected} FROM {source}{where} ORDER BY date DESC LIMIT ?) ORDER BY date", params
+
+def read_table(ticker, table, sql_conn, **filters):
+    query, params = build_query(ticker, table, sql_conn, **filters)
+    stock_data = pd.read_sql(query, sql_conn, params=params)
+    stock_data['date'] = pd.to_datetime(stock_data['date'])
+    stock_data.set_index('date', inplace=True)
+    return stock_data
+
+def read_prices(ticker, sql_conn, **filters):
+    return read_table(ticker, 'prices', sql_conn, **filters)
+
+def read_ranks(ticker, sql_conn, **filters):
+    return read_table(ticker, 'ranks', sql_conn, **filters)
+
+#columns, start/end (inclusive) and last_n are applied in SQL, or as slices of the columnar cache
+def load_prices(ticker, sql_conn, columns=None, start=None, end=None, last_n=None, use_cache=True):
+    stock_prices = columnar_cache.load(ticker, 'prices', sql_conn, read_prices,
+                                       columns, start, end, last_n) if use_cache else None
+    if stock_prices is None:
+        stock_prices = read_prices(ticker, sql_conn, columns=columns, start=start, end=end, last_n=last_n)
     return stock_prices
 
-def load_ranks(ticker, sql_conn):
-    stock_ranks = pd.read_sql(f'SELECT * FROM {ticker}_ranks', sql_conn)
-    stock_ranks['date'] = pd.to_datetime(stock_ranks['date'])
-    stock_ranks.set_index('date', inplace=True)
+def load_ranks(ticker, sql_conn, columns=None, start=None, end=None, last_n=None, use_cache=True):
+    stock_ranks = columnar_cache.load(ticker, 'ranks', sql_conn, read_ranks,
+                                      columns, start, end, last_n) if use_cache else None
+    if stock_ranks is None:
+        stock_ranks = read_ranks(ticker, sql_conn, columns=columns, start=start, end=end, last_n=last_n)
     return stock_ranks
 
+def build_panel_query(tickers, sql_conn, field, start=None, end=None, last_n=None):
+    conditions, params = [], []
+    add_date_range(conditions, params, start, end)
+    long_store = has_price_store(sql_conn)
+    if long_store and last_n is None:
+        conditions.insert(0, f"act_symbol IN ({', '.join('?' for _ in tickers)})")
+        return f'SELECT date, act_symbol, "{field}" AS value FROM prices WHERE {" AND ".join(conditions)}', \
+            [*tickers, *params]
+    if long_store:
+        #One LIMIT subquery per ticker walks the (act_symbol, date) index backwards and stops after last_n rows,
+        #a window function over the IN list would sort every ticker's whole history first
+        conditions.insert(0, "act_symbol = ?")
+    else:
+        #Tickers without a table are left out of the union and come back as NaN columns, as in the long store
+        existing_tables = {name for (name,) in sql_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        tickers = [ticker for ticker in tickers if f"{ticker}_prices" in existing_tables]
+        if not tickers:
+            return None, []
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit = "" if last_n is None else f" ORDER BY date DESC LIMIT {int(last_n)}"
+    selects, union_params = [], []
+    for ticker in tickers:
+        source, ticker_params = ("prices", [ticker, ticker, *params]) if long_store \
+            else (f'"{ticker}_prices"', [ticker, *params])
+        selects.append(f'SELECT * FROM (SELECT date, ? AS act_symbol, "{field}" AS value '
+                       f'FROM {source}{where}{limit})')
+        union_params += ticker_params
+    return ' UNION ALL '.join(selects), union_params
+
+#Reads one field for many tickers in bulk; returns a dates x tickers float64 frame and a mask of present values
+def load_price_panel(tickers, sql_conn, field='close', start=None, end=None, last_n=None, chunk_size=200):
+    tickers = list(tickers)
+    chunks = []
+    for offset in range(0, len(tickers), chunk_size):
+        query, params = build_panel_query(tickers[offset:offset + chunk_size], sql_conn, field, start, end, last_n)
+        if query is not None:
+            chunks.append(pd.read_sql(query, sql_conn, params=params))
+    values = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=['date', 'act_symbol', 'value'])
+    values['date'] = pd.to_datetime(values['date'])
+    panel = values.pivot(index='date', columns='act_symbol', values='value') \
+        .reindex(columns=tickers) \
+        .sort_index() \
+        .astype('float64')
+    panel.columns.name = None
+    return panel, panel.notna().to_numpy()
+
+#Server-side paging for the dashboard price table. Only these columns can be sorted or filtered on,
+#so user input never reaches the SQL text other than as bound parameters
+page_columns = ['date', 'open', 'high', 'low', 'close', 'volume']
+filter_operators = {
+    '=': '=', 'eq': '=', '!=': '!=', 'ne': '!=',
+    '<': '<', 'lt': '<', '<=': '<=', 'le': '<=',
+    '>': '>', 'gt': '>', '>=': '>=', 'ge': '>=',
+    'contains': 'LIKE', 'datestartswith': 'LIKE'
+}
+filter_part_pattern = re.compile(r"^\{(\w+)\}\s*(s?(?:<=|>=|!=|<|>|=)|eq|ne|lt|le|gt|ge|contains|datestartswith)\s*(.*)$")
+
+#Translates a DataTable filter_query such as '{close} > 10 && {date} datestartswith 2023' into SQL
+#conditions; parts on unknown columns or with unknown operators are ignored
+def parse_filter_query(filter_query):
+    conditions, params = [], []
+    for part in (filter_query or '').split(' && '):
+        match = filter_part_pattern.match(part.strip())
+        if match is None or match.group(1) not in page_columns:
+            continue
+        column, operator, value = match.group(1), match.group(2).lstrip('s'), match.group(3).strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in ('"', "'", '`'):
+            value = value[1:-1]
+        if operator == 'contains':
+            value = f"%{value}%"
+        elif operator == 'datestartswith':
+            value = f"{value}%"
+        elif column != 'date':
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+        conditions.append(f'"{column}" {filter_operators[operator]} ?')
+        params.append(value)
+    return conditions, params
+
+#Returns one page of a ticker's prices as a frame with the date as text, and the number of matching rows
+def load_price_page(ticker, sql_conn, page_current=0, page_size=10, sort_by=None, filter_query=''):
+    if has_price_store(sql_conn):
+        source, conditions, params = 'prices', ["act_symbol = ?"], [ticker]
+    else:
+        source, conditions, params = f'"{ticker}_prices"', [], []
+    filter_conditions, filter_params = parse_filter_query(filter_query)
+    conditions += filter_conditions
+    params += filter_params
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    order = [f'"{sort["column_id"]}" {"DESC" if sort["direction"] == "desc" else "ASC"}'
+             for sort in (sort_by or []) if sort['column_id'] in page_columns]
+    #date is unique per ticker, so pages stay stable when sorting on a column with ties
+    order.append("date")
+
+    row_count = sql_conn.execute(f"SELECT COUNT(*) FROM {source}{where}", params).fetchone()[0]
+    query = (f"SELECT {', '.join(page_columns)} FROM {source}{where} "
+             f"ORDER BY {', '.join(order)} LIMIT ? OFFSET ?")
+    page = pd.read_sql(query, sql_conn, params=[*params, page_size, page_current * page_size])
+    return page, row_count
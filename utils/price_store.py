@@ -0,0 +1,131 @@
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+#Long-format layout: one table per dataset keyed by (act_symbol, date)
+price_columns = ['date', 'act_symbol', 'open', 'high', 'low', 'close', 'volume']
+rank_columns = ['date', 'act_symbol', 'rank']
+
+schema = """
+CREATE TABLE IF NOT EXISTS prices (
+    date TEXT NOT NULL,
+    act_symbol TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume INTEGER,
+    PRIMARY KEY (act_symbol, date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS ranks (
+    date TEXT NOT NULL,
+    act_symbol TEXT NOT NULL,
+    rank TEXT,
+    PRIMARY KEY (act_symbol, date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    source TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    watermark TEXT,
+    refreshed_at TEXT NOT NULL
+);
+"""
+
+#Cross-sectional lookups ("all closes on date X") are answered from the index alone
+indexes = """
+CREATE INDEX IF NOT EXISTS prices_date_idx ON prices (date, act_symbol, close);
+CREATE INDEX IF NOT EXISTS ranks_date_idx ON ranks (date, act_symbol, rank);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def create_price_store(conn, replace=False):
+    if replace:
+        conn.executescript("DROP TABLE IF EXISTS prices; DROP TABLE IF EXISTS ranks; "
+                           "DROP TABLE IF EXISTS ingest_manifest;")
+    conn.executescript(schema)
+
+
+def create_indexes(conn):
+    conn.executescript(indexes)
+    conn.execute("ANALYZE")
+
+
+#Bulk loads go through an unindexed rowid table and are merged in key order afterwards,
+#so the (act_symbol, date) b-tree is built by appending instead of random inserts
+def create_staging_table(conn, table):
+    conn.execute(f"DROP TABLE IF EXISTS temp.staging_{table}")
+    conn.execute(f"CREATE TEMP TABLE staging_{table} AS SELECT * FROM main.{table} WHERE 0")
+
+
+def stage_rows(conn, table, columns, rows):
+    placeholders = ', '.join('?' for _ in columns)
+    conn.executemany(
+        f"INSERT INTO temp.staging_{table} ({', '.join(columns)}) VALUES ({placeholders})",
+        rows)
+
+
+def merge_staging(conn, table, columns, skip_unchanged=False):
+    #With skip_unchanged, staged rows identical to the stored ones are filtered out in SQL so that
+    #re-read history is compared set-based instead of being rewritten
+    unchanged = ""
+    if skip_unchanged:
+        same = ' AND '.join(f"stored.{column} IS staged.{column}" for column in columns)
+        unchanged = f" WHERE NOT EXISTS (SELECT 1 FROM main.{table} AS stored WHERE {same})"
+    conn.execute(f"INSERT OR REPLACE INTO main.{table} ({', '.join(columns)}) "
+                 f"SELECT {', '.join(columns)} FROM temp.staging_{table} AS staged{unchanged} "
+                 f"ORDER BY act_symbol, date, rowid")
+    conn.execute(f"DROP TABLE temp.staging_{table}")
+
+
+def load_watermarks(conn, table):
+    return dict(conn.execute(f"SELECT act_symbol, MAX(date) FROM {table} GROUP BY act_symbol").fetchall())
+
+
+def read_manifest(conn, source):
+    cursor = conn.execute("SELECT size, mtime_ns, rows, watermark FROM ingest_manifest WHERE source = ?", (source,))
+    return cursor.fetchone()
+
+
+def write_manifest(conn, source, table, size, mtime_ns, rows):
+    watermark = conn.execute(f"SELECT MAX(date) FROM {table}").fetchone()[0]
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO ingest_manifest VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (source, table, size, mtime_ns, rows, watermark,
+                      datetime.now(timezone.utc).isoformat()))
+
+
+def has_price_store(conn):
+    cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='prices'")
+    return cursor.fetchone() is not None
+
+
+def database_path(conn):
+    for _, name, path in conn.execute("PRAGMA database_list").fetchall():
+        if name == 'main':
+            return path or None
+    return None
+
+
+def db_version(conn):
+    #Changes whenever the database is refreshed; None for in-memory databases
+    if has_price_store(conn):
+        refreshed_at = conn.execute("SELECT MAX(refreshed_at) FROM ingest_manifest").fetchone()[0]
+        if refreshed_at is not None:
+            return refreshed_at
+    path = database_path(conn)
+    if path is None:
+        return None
+    stats = [os.stat(file) for file in (path, f"{path}-wal") if os.path.exists(file)]
+    return '-'.join(f"{stat.st_mtime_ns}:{stat.st_size}" for stat in stats)
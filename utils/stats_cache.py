@@ -0,0 +1,102 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.load_stock import load_prices
+from utils.price_store import db_version
+
+#Derived per-ticker series keyed by (ticker, statistic, params, source version). The source version
+#changes whenever the price database is refreshed, so stale entries are simply never hit again and
+#age out of the LRU; nothing is cached for in-memory databases, which have no version
+memory_cache = OrderedDict()
+memory_cache_size = 512
+#Dash callbacks run on several threads; the LRU bookkeeping is guarded, computations run unlocked
+memory_cache_lock = threading.Lock()
+
+#Optional second tier of pickled values shared between processes and dashboard restarts, off by default
+disk_cache_dir = None
+
+
+def configure(memory_size=None, disk_dir=None):
+    global memory_cache_size, disk_cache_dir
+    if memory_size is not None:
+        memory_cache_size = memory_size
+    disk_cache_dir = disk_dir
+
+
+def clear():
+    with memory_cache_lock:
+        memory_cache.clear()
+
+
+def cache_key(ticker, statistic, params, version):
+    return ticker, statistic, repr(sorted(params.items())), version
+
+
+def disk_path(key):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(disk_cache_dir, key[1], f"{digest}.pkl")
+
+
+def read_disk(key):
+    path = disk_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as file:
+            stored_key, value = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    #Guards against digest collisions
+    return value if stored_key == key else None
+
+
+def write_disk(key, value):
+    path = disk_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    #A temp file per writer, threads of one process may store the same key at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as file:
+        pickle.dump((key, value), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def remember(key, value):
+    with memory_cache_lock:
+        memory_cache[key] = value
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > memory_cache_size:
+            memory_cache.popitem(last=False)
+
+
+#Returns compute() for the statistic, computing it only when it is not cached for the current database.
+#params must fully describe the computation; callers get a shared object and must not modify it
+def cached(ticker, statistic, conn, compute, **params):
+    version = db_version(conn)
+    if version is None:
+        return compute()
+    key = cache_key(ticker, statistic, params, version)
+    with memory_cache_lock:
+        if key in memory_cache:
+            memory_cache.move_to_end(key)
+            return memory_cache[key]
+    value = read_disk(key) if disk_cache_dir is not None else None
+    if value is None:
+        value = compute()
+        if disk_cache_dir is not None:
+            write_disk(key, value)
+    remember(key, value)
+    return value
+
+
+def log_returns(ticker, conn, last_n=None):
+    def compute():
+        close = load_prices(ticker, conn, columns=['close'], last_n=last_n)['close']
+        return np.log(close / close.shift(1)).dropna()
+    return cached(ticker, 'log_returns', conn, compute, last_n=last_n)
+